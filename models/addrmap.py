@@ -0,0 +1,218 @@
+"""
+A map from int addresses to int metadata, stored in two flat arrays with open
+addressing instead of a dict, for GCModel._metadata when a TraceRunner is made
+with compact=True (runtrace.py --compact-metadata). A dict spends ~100 bytes
+per live allocation on its slot and the key and value objects; an AddrMap
+spends 16 bytes per slot (at most 2/3 of slots are used), so models tracking
+millions of live allocations take a fraction of the memory.
+
+The memory costs time: every operation runs in Python rather than in dict's C
+code, so lookups are slower than in a dict, not faster. Replaying a 2M-event
+trace that ends with 1.6M live allocations took 110 MB of peak RSS and about
+11.5s with an AddrMap, against 196 MB and 10s with a dict of int addresses and
+315 MB and 10.5s with the dict of hex strings GCModel used to keep.
+
+Removing a key leaves no marker in its slot; the keys after it that probed
+past it move back instead, so inserts find a free slot where a probe ends and
+the table only grows once it's 2/3 full of live keys.
+
+Keys that aren't ints in [1, 2**64) are kept in an ordinary dict on the side.
+Values that don't fit in a C long are kept in another, for just those keys,
+with BOXED in their slot. So any address and any metadata a model returns
+still work, just without the savings. Values come back as the ints they're
+stored as, though, so metadata of True or False reads back as 1 or 0.
+"""
+
+from array import array
+from itertools import izip
+
+EMPTY = 0 # a slot without a key; ends a probe sequence
+KEY_LIMIT = 2**64
+
+BOXED = -2**63 # the value of a slot whose value is in _boxed
+
+MIN_CAPACITY = 8
+
+def _start(key, mask):
+  # addresses are aligned, so mix the high bits into the low ones
+  return (key ^ (key >> 7) ^ (key >> 19)) & mask
+
+class AddrMap(object):
+  def __init__(self, capacity=MIN_CAPACITY):
+    size = MIN_CAPACITY
+    while size * 2 < capacity * 3:
+      size *= 2
+    self._clear(size)
+    self._other = {} # the keys that don't fit in the arrays, and their values
+    self._boxed = {} # the values that don't fit in the arrays, by key
+
+  def _clear(self, size):
+    self._keys = array('L', [EMPTY]) * size
+    self._values = array('l', [0]) * size
+    self._mask = size - 1
+    self._limit = size * 2 // 3 # the most slots that may be used
+    self._room = self._limit # slots that may still be used before a resize
+
+  def _slot(self, key):
+    """
+    Returns the slot holding `key`, or the EMPTY slot ending its probe
+    sequence as its ones' complement.
+    """
+    keys, mask = self._keys, self._mask
+    i = _start(key, mask)
+    while True:
+      k = keys[i]
+      if k == key:
+        return i
+      if k == EMPTY:
+        return ~i
+      i = (i + 1) & mask
+
+  def _resize(self):
+    """ Rehashes into a table twice the size. """
+    old_keys, old_values = self._keys, self._values
+    used = self._limit - self._room
+    self._clear(len(old_keys) * 2)
+
+    keys, values, mask = self._keys, self._values, self._mask
+    for key, value in izip(old_keys, old_values):
+      if key != EMPTY:
+        i = (key ^ (key >> 7) ^ (key >> 19)) & mask
+        while keys[i] != EMPTY:
+          i = (i + 1) & mask
+        keys[i] = key
+        values[i] = value
+    self._room -= used
+
+  def _remove(self, i):
+    """
+    Empties slot `i`. Deleted slots aren't marked, so the keys after it on the
+    same run of slots that probed past it are moved back instead.
+    """
+    keys, values, mask = self._keys, self._values, self._mask
+    j = i
+    while True:
+      j = (j + 1) & mask
+      k = keys[j]
+      if k == EMPTY: break
+      # k moves back to i if i is on its probe sequence, from its start to j
+      if (j - _start(k, mask)) & mask >= (j - i) & mask:
+        keys[i] = k
+        values[i] = values[j]
+        i = j
+    keys[i] = EMPTY
+
+  # __setitem__, __getitem__ and pop are on the path of every allocation and
+  # free a model replays, so they inline _start and the common case, and let
+  # the array conversions reject keys and values that don't fit
+
+  def __setitem__(self, key, value):
+    keys, mask = self._keys, self._mask
+    try:
+      i = (key ^ (key >> 7) ^ (key >> 19)) & mask
+      if key > EMPTY:
+        while True:
+          k = keys[i]
+          if k == EMPTY:
+            if not self._room: break
+            self._values[i] = value
+            keys[i] = key
+            self._room -= 1
+            return
+          if k == key:
+            self._values[i] = value
+            if self._boxed: self._boxed.pop(key, None)
+            return
+          i = (i + 1) & mask
+    except (TypeError, OverflowError):
+      pass
+    self._set(key, value)
+
+  def _set(self, key, value):
+    try:
+      i = self._slot(key) if EMPTY < key < KEY_LIMIT else None
+    except TypeError: # not an int
+      i = None
+    if i is None:
+      self._other[key] = value
+      return
+
+    if i < 0:
+      if not self._room:
+        self._resize()
+        i = self._slot(key)
+      i = ~i
+      self._keys[i] = key
+      self._room -= 1
+    try:
+      self._values[i] = value
+    except (TypeError, OverflowError):
+      self._values[i] = BOXED
+      self._boxed[key] = value
+      return
+    if self._boxed: self._boxed.pop(key, None)
+
+  def __getitem__(self, key):
+    keys, mask = self._keys, self._mask
+    try:
+      i = (key ^ (key >> 7) ^ (key >> 19)) & mask
+    except TypeError:
+      return self._other[key]
+    if key > EMPTY:
+      while True:
+        k = keys[i]
+        if k == key:
+          value = self._values[i]
+          return value if value != BOXED else self._boxed.get(key, value)
+        if k == EMPTY: break
+        i = (i + 1) & mask
+    return self._other[key]
+
+  def pop(self, key, *default):
+    """ Removes `key` and returns its value, like dict.pop. """
+    keys, mask = self._keys, self._mask
+    try:
+      i = (key ^ (key >> 7) ^ (key >> 19)) & mask
+    except TypeError:
+      return self._other.pop(key, *default)
+    if key > EMPTY:
+      while True:
+        k = keys[i]
+        if k == key:
+          value = self._values[i]
+          if keys[(i + 1) & mask] == EMPTY:
+            keys[i] = EMPTY # nothing probed past it
+          else:
+            self._remove(i)
+          self._room += 1
+          return value if value != BOXED else self._boxed.pop(key, value)
+        if k == EMPTY: break
+        i = (i + 1) & mask
+    return self._other.pop(key, *default)
+
+  def __delitem__(self, key):
+    self.pop(key)
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def __contains__(self, key):
+    missing = []
+    return self.get(key, missing) is not missing
+
+  def __len__(self):
+    return self._limit - self._room + len(self._other)
+
+  def __iter__(self):
+    keys = self._keys
+    for i in xrange(len(keys)):
+      if keys[i] != EMPTY:
+        yield keys[i]
+    for key in self._other.keys():
+      yield key
+
+  def items(self):
+    return [(key, self[key]) for key in self]
@@ -0,0 +1,325 @@
+#!/usr/bin/python
+"""
+Runs models on a corpus of filtered traces from several workloads (boot, kernel
+build, network load, ...) and reports each model's weighted total over the
+corpus along with a breakdown by workload:
+
+  ./corpus.py traces/
+  ./corpus.py corpus.json -m slab.SlabAllocatorFamily --memory 4096
+
+The corpus is either a directory, whose traces (*.json and *.msgpack, the
+msgpack one if a trace is in both) each have weight 1 and form a workload of
+their own, or a json manifest:
+
+  {"traces": [{"path": "boot-1.msgpack", "workload": "boot", "weight": 2},
+              {"path": "build.json", "workload": "build", "weight": 0.5}]}
+
+where paths are relative to the manifest, the workload defaults to the trace's
+name and the weight to 1. A workload's time is the weighted sum of the times of
+its traces, and the corpus total is the sum over all traces.
+
+Each trace runs all the models in a worker process of its own, so the memory
+of one trace is returned before the next is loaded, and a worker that dies
+(killed for running out of memory, say) only fails its own trace. With
+--memory, traces are only started while the estimated memory of the running
+ones fits in the budget (json traces are loaded whole and take about
+JSON_MEMORY_FACTOR times their size; msgpack traces are streamed).
+
+Every result is appended to a journal (<corpus>.journal.jsonl by default) as
+soon as its trace is done, so an interrupted run picks up where it left off
+when it is started again. Results of traces that changed since they were
+journaled are recomputed. Use --restart to discard the journal.
+"""
+
+import os, sys, argparse, csv, json, signal, time
+import multiprocessing as mp
+import gcmodel, runtrace, tracefile
+
+TRACE_EXTENSIONS = [".msgpack", ".json"]
+
+# rough peak memory of replaying a trace, as a multiple of its file size
+JSON_MEMORY_FACTOR = 10
+MSGPACK_MEMORY_FACTOR = 6
+BASE_MEMORY = 20 * 2**20
+
+POLL_INTERVAL = 0.1 # seconds between checks on the running workers
+
+class Trace(object):
+  def __init__(self, path, workload=None, weight=1.0):
+    # journal entries are keyed on the path, so spell it one way
+    self.path = os.path.abspath(path)
+    self.workload = workload or os.path.splitext(os.path.basename(path))[0]
+    self.weight = float(weight)
+    self._memory = None
+
+  def stamp(self):
+    """ Returns the (size, mtime) that identifies this version of the trace. """
+    stat = os.stat(self.path)
+    return stat.st_size, stat.st_mtime
+
+  def memory(self):
+    """ Returns an estimate of the peak memory of replaying the trace. """
+    if self._memory is None:
+      with open(self.path, 'rb') as f:
+        is_msgpack, _ = tracefile.open_trace(f)
+      factor = MSGPACK_MEMORY_FACTOR if is_msgpack else JSON_MEMORY_FACTOR
+      self._memory = BASE_MEMORY + factor * os.path.getsize(self.path)
+    return self._memory
+
+def load_corpus(path):
+  """ Returns the Traces of the corpus directory or manifest at `path`. """
+  if os.path.isdir(path):
+    traces = {}
+    for name in sorted(os.listdir(path)):
+      stem, extension = os.path.splitext(name)
+      if extension not in TRACE_EXTENSIONS: continue
+      # json_to_msgpack.py writes trace.msgpack next to trace.json
+      if stem in traces and TRACE_EXTENSIONS.index(extension) > \
+          TRACE_EXTENSIONS.index(os.path.splitext(traces[stem].path)[1]):
+        continue
+      traces[stem] = Trace(os.path.join(path, name))
+    return [traces[stem] for stem in sorted(traces)]
+
+  with open(path, 'r') as f:
+    manifest = json.load(f)
+  directory = os.path.dirname(path)
+  return [Trace(os.path.join(directory, entry["path"]), entry.get("workload"),
+      entry.get("weight", 1.0)) for entry in manifest["traces"]]
+
+def read_journal(filename):
+  """ Returns {(trace path, model): journal entry} of the results so far. """
+  done = {}
+  if not os.path.exists(filename): return done
+  with open(filename, 'r') as f:
+    for line in f:
+      try:
+        entry = json.loads(line)
+      except ValueError:
+        continue # a line cut short by an interrupted run
+      done[(entry["trace"], entry["model"])] = entry
+  return done
+
+def run_trace(task):
+  """
+  Runs each model in `models` on the trace `path`. Returns (path, [(model,
+  time)], None), or (path, None, error) if a model failed.
+  """
+  path, models, use_cache = task
+  try:
+    runner = gcmodel.TraceRunner(path, use_cache)
+    return path, [(model, runner.run_one(runtrace.load_model(model)))
+        for model in models], None
+  except Exception as e:
+    return path, None, "%s: %s" % (type(e).__name__, e)
+
+def _worker(conn, task):
+  # the parent stops the workers itself when it's interrupted
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  conn.send(run_trace(task))
+  conn.close()
+
+def run_corpus(traces, models, jobs, journal, memory=None, use_cache=True):
+  """
+  Runs every model on every trace that doesn't have a result in the `journal`
+  file yet, `jobs` traces at a time and within `memory` bytes if given.
+  Returns {(trace path, model): time} for the traces that ran, and the number
+  of traces that failed.
+  """
+  done = read_journal(journal)
+  results, pending = {}, []
+  for trace in traces:
+    stamp = list(trace.stamp())
+    missing = []
+    for model in models:
+      entry = done.get((trace.path, model))
+      if entry is not None and entry["stamp"] == stamp:
+        results[(trace.path, model)] = entry["time"]
+      else:
+        missing.append(model)
+    if missing:
+      pending.append((trace, missing))
+
+  if not pending: return results, 0
+  print >> sys.stderr, "Running %d of %d traces (%d results from %s)" % (
+      len(pending), len(traces), len(results), journal)
+
+  # the largest traces go first so they don't finish last
+  pending.sort(key=lambda (trace, _): trace.memory(), reverse=True)
+  running = {} # path -> (Trace, worker process, result connection)
+  try:
+    with open(journal, 'a') as out:
+      failed = _schedule(running, pending, out, results, jobs, memory,
+          use_cache)
+  finally:
+    for _, process, _ in running.values(): # the journal keeps what's done
+      process.terminate()
+      process.join()
+  return results, failed
+
+def _finished(running):
+  """
+  Waits for one of the `running` workers to finish and returns its Trace and
+  (path, times, error), removing it from `running`.
+  """
+  while True:
+    for path, (trace, process, conn) in running.items():
+      # the pipe is readable once the worker sent its result or exited
+      if not conn.poll(): continue
+      try:
+        result = conn.recv()
+      except EOFError: # killed, or out of memory
+        process.join()
+        result = path, None, "worker died with exit code %s" % process.exitcode
+      conn.close()
+      process.join()
+      del running[path]
+      return trace, result
+    time.sleep(POLL_INTERVAL)
+
+def _schedule(running, pending, out, results, jobs, memory, use_cache):
+  """
+  Runs the `pending` traces in worker processes, tracked in `running`,
+  journaling their results to `out` as they finish. Returns the number of
+  traces that failed.
+  """
+  reserved, count, failed = 0, 0, 0
+  while pending or running:
+    # start what fits: always at least one trace, however large
+    while pending and len(running) < jobs:
+      trace, missing = pending[0]
+      if memory and running and reserved + trace.memory() > memory: break
+      pending.pop(0)
+      conn, child = mp.Pipe(duplex=False)
+      process = mp.Process(target=_worker,
+          args=(child, (trace.path, missing, use_cache)))
+      process.start()
+      child.close()
+      running[trace.path] = trace, process, conn
+      reserved += trace.memory()
+
+    trace, (path, times, error) = _finished(running)
+    reserved -= trace.memory()
+    count += 1
+    if error:
+      print >> sys.stderr, "[%d/%d] %s failed: %s" % (count,
+          count + len(pending) + len(running), path, error)
+      failed += 1
+      continue
+
+    stamp = list(trace.stamp())
+    for model, seconds in times:
+      results[(path, model)] = seconds
+      out.write(json.dumps({"trace": path, "model": model, "time": seconds,
+          "stamp": stamp}) + "\n")
+    out.flush()
+    print >> sys.stderr, "[%d/%d] %s" % (count,
+        count + len(pending) + len(running), path)
+  return failed
+
+def aggregate(traces, models, results):
+  """
+  Returns ({workload: {model: weighted time}}, {model: weighted total}).
+  """
+  workloads, totals = {}, dict.fromkeys(models, 0.0)
+  for trace in traces:
+    times = workloads.setdefault(trace.workload, dict.fromkeys(models, 0.0))
+    for model in models:
+      weighted = trace.weight * results[(trace.path, model)]
+      times[model] += weighted
+      totals[model] += weighted
+  return workloads, totals
+
+def print_report(traces, models, workloads, totals, baseline):
+  names = []
+  for trace in traces:
+    if trace.workload not in names: names.append(trace.workload)
+
+  def cells(times):
+    base = times[baseline]
+    return ["%.2f (%.2fx)" % (times[m], times[m] / base if base else
+        float('nan')) for m in models]
+
+  rows = [["workload"] + models]
+  rows += [[name] + cells(workloads[name]) for name in names]
+  rows.append(["weighted total"] + cells(totals))
+
+  widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+  print "Weighted over", len(traces), "traces, relative to", baseline
+  for row in rows:
+    print "  ".join(cell.ljust(width)
+        for cell, width in zip(row, widths)).rstrip()
+
+def write_csv(filename, traces, models, results):
+  with open(filename, 'w') as f:
+    writer = csv.writer(f)
+    writer.writerow(["workload", "trace", "weight", "model", "time",
+        "weighted_time"])
+    for trace in traces:
+      for model in models:
+        time = results[(trace.path, model)]
+        writer.writerow([trace.workload, trace.path, trace.weight, model, time,
+            trace.weight * time])
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("corpus", type=str,
+      help="a directory of filtered traces or a json manifest. required")
+  parser.add_argument("-m", "--model", dest="models", action="append",
+      help="the full import path of a model to run. may be repeated " +
+      "(all of runtrace.MODELS)")
+  parser.add_argument("--baseline", type=str, default=None,
+      help="the model the others are compared to (the first model)")
+  parser.add_argument("-j", "--jobs", type=int, default=mp.cpu_count(),
+      help="number of traces to run at once (cpu count)")
+  parser.add_argument("--memory", type=int, default=None,
+      help="memory budget in MB for the traces running at once (none)")
+  parser.add_argument("--journal", type=str, default=None,
+      help="file recording the results so far (<corpus>.journal.jsonl)")
+  parser.add_argument("--restart", action="store_true",
+      help="discard the journal and run the whole corpus again")
+  parser.add_argument("--no-cache", dest="use_cache", action="store_false",
+      help="don't read or write the result cache ($AUTOGC_CACHE_DIR)")
+  parser.add_argument("--csv", type=str, default=None,
+      help="also write the per-trace results to this csv file")
+  args = parser.parse_args()
+
+  args.models = args.models or list(runtrace.MODELS)
+  args.baseline = args.baseline or args.models[0]
+  if args.baseline not in args.models:
+    args.models.append(args.baseline)
+  runtrace.check_models(parser, args.models)
+
+  try:
+    args.traces = load_corpus(args.corpus)
+  except (IOError, OSError, ValueError, KeyError) as e:
+    parser.error("invalid corpus: " + str(e))
+  if not args.traces:
+    parser.error("no traces in the corpus")
+  paths = set()
+  for trace in args.traces:
+    if not os.path.isfile(trace.path):
+      parser.error("no such trace: " + trace.path)
+    if trace.path in paths:
+      parser.error("trace listed twice: " + trace.path)
+    paths.add(trace.path)
+
+  args.journal = args.journal or \
+      os.path.abspath(args.corpus) + ".journal.jsonl"
+  if args.memory:
+    args.memory *= 2**20
+  return args
+
+if __name__ == "__main__":
+  args = parse_args()
+  if args.restart and os.path.exists(args.journal):
+    os.remove(args.journal)
+
+  results, failed = run_corpus(args.traces, args.models, args.jobs,
+      args.journal, args.memory, args.use_cache)
+  if failed:
+    print >> sys.stderr, failed, "traces failed; run again to retry them"
+    sys.exit(1)
+  workloads, totals = aggregate(args.traces, args.models, results)
+  print_report(args.traces, args.models, workloads, totals, args.baseline)
+  if args.csv:
+    write_csv(args.csv, args.traces, args.models, results)
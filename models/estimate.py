@@ -0,0 +1,63 @@
+#!/usr/bin/python
+"""
+Runs a model on several samples of a trace generated by scripts/sample.py and
+reports the estimated full-trace time with error bounds. Each sample's result
+is already scaled by the TraceRunner using the sample's .scale sidecar; the
+spread across samples gives a confidence interval for the estimate.
+
+  ./estimate.py simple_malloc.SimpleMalloc sample.0.json sample.1.json ...
+"""
+
+import argparse, gcmodel, math
+from runtrace import load_model
+
+# two-sided 95% critical values of Student's t distribution by degrees of
+# freedom; the normal approximation is used past the end of the table
+T_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+        2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+        2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+def summarize(results):
+  """ Returns (mean, standard deviation, 95% confidence half-width). """
+  n = len(results)
+  mean = sum(results) / float(n)
+  if n < 2:
+    return mean, float('nan'), float('nan')
+  stddev = math.sqrt(sum((r - mean)**2 for r in results) / (n - 1))
+  t = T_95[n - 2] if n - 2 < len(T_95) else 1.96
+  return mean, stddev, t * stddev / math.sqrt(n)
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("model", type=str,
+      help="the full import path of the model to run the samples on." +
+      " example: simple_malloc.SimpleMalloc")
+  parser.add_argument("filenames", metavar="sample.json", type=str, nargs="+",
+      help="filenames for sampled trace json. required")
+  parser.add_argument("--no-cache", dest="use_cache", action="store_false",
+      help="don't read or write the result cache ($AUTOGC_CACHE_DIR)")
+  args = parser.parse_args()
+
+  try:
+    args.model = load_model(args.model)
+  except ImportError as e:
+    parser.error("could not import module: " + str(e))
+  except AttributeError as e:
+    parser.error("couldn't find the model: " + str(e))
+  except:
+    parser.error("the model path is not valid")
+
+  return args
+
+if __name__ == "__main__":
+  args = parse_args()
+  results = []
+  for filename in args.filenames:
+    runner = gcmodel.TraceRunner(filename, args.use_cache)
+    result = runner.run_one(args.model)
+    print "%s: %.2f" % (filename, result)
+    results.append(result)
+
+  mean, stddev, bound = summarize(results)
+  print "Estimate: %.2f +/- %.2f (95%% CI, stddev %.2f, %d samples)" \
+      % (mean, bound, stddev, len(results))
@@ -13,5 +13,4 @@ if ! [ -e $trace ] || [ -z $trace ]; then
   exit 1
 fi
 
-./runtrace.py simple_malloc.SimpleMalloc $trace
-./runtrace.py slab.SlabAllocatorFamily $trace
+./runtrace.py -m simple_malloc.SimpleMalloc -m slab.SlabAllocatorFamily $trace
@@ -12,6 +12,35 @@ The chain above does the following:
 This library provides two classes: TraceRunner, GCModel. A TraceRunner instance
 runs the trace through one or more GCModels.
 
+If the trace is a sample generated by scripts/sample.py, the TraceRunner reads
+its <trace>.scale sidecar and scales the time a model spends on each entry by
+the factor its label was thinned out by, so results estimate the full trace.
+
+The trace may also be in msgpack (see scripts/json_to_msgpack.py), detected by
+its extension or first byte. msgpack traces are streamed from disk on each run
+instead of being loaded whole, so a run's memory doesn't grow with the trace.
+Either way, addresses are parsed into ints as the trace is read, and models'
+allocation metadata is kept in a dict keyed by them. A runner made with
+compact=True keeps it in an AddrMap (see addrmap.py) instead, which takes a
+fraction of the memory on traces with millions of live allocations but replays
+more slowly.
+
+Results are cached on disk (see scripts/cache.py) keyed by the trace's content
+hash, its .scale sidecar and the source of the modules that define the model
+and its base classes, which includes their Consts. Re-running an unchanged
+model on an unchanged trace returns its stored result without replaying the
+trace; editing a model only invalidates that model's results.
+
+A runner given a `progress` queue puts a (trace, model, entries replayed,
+fraction of the trace replayed, model time) report on it every
+PROGRESS_INTERVAL entries, which runtrace.py shows as a status line.
+
+Models may record named metrics besides their time: gauges with set_gauge (eg,
+the heap footprint) and counters with add_count (eg, the collections run).
+TraceRunner.run_metrics samples them every so many entries or seconds of trace
+time into a Metrics, which keeps one array per metric, so a model's behavior
+through the trace can be plotted rather than just its final time.
+
 TODO: Add debugging flag, perhaps via env variable that:
   1) Prints out each alloc/free and the time it tooks.
   2) Prints out some statistics, like avg/variance.
@@ -23,42 +52,301 @@ TODO: Have some way for models to specify allocator parameters. Goals:
   3) Should be Pythonic.
 """
 
-import os, sys, argparse, json, copy_reg, types, inspect
+import os, sys, argparse, json, copy_reg, types, inspect, itertools, math
+from array import array
 import multiprocessing as mp
 
+# the repository, whose models and scripts a replay's result may depend on
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the trace readers are shared with the analysis scripts
+sys.path.append(os.path.join(PROJECT_DIR, "scripts"))
+import tracefile, cache
+from addrmap import AddrMap
+
 # global constants
 BAD_FREE_TYPE = -1
 FREE_TYPE = 0
 ALLOC_TYPE = 1
 
+# bump whenever the way a trace is replayed or a result is computed changes
+# outside the project sources in cached results' keys (see replay_sources)
+REPLAY_VERSION = 1
+
+# the number of entries replayed between progress reports
+PROGRESS_INTERVAL = 20000
+
+def load_scale(filename):
+  """
+  Returns the sampling scale factors written by sample.py for the trace
+  `filename` as (default factor, {label: factor}), or None if the trace wasn't
+  sampled.
+  """
+  try:
+    with open(filename + ".scale", 'r') as f:
+      sidecar = json.load(f)
+  except IOError:
+    return None
+  return sidecar['default_scale'], sidecar['scale']
+
+def model_sources(model):
+  """
+  Returns the paths of the source files of the modules defining `model` and its
+  base classes, or None if any of them isn't available (eg, a model defined in
+  an interactive session).
+  """
+  paths = []
+  for cls in inspect.getmro(model):
+    if cls is object: continue
+    try:
+      path = inspect.getsourcefile(sys.modules[cls.__module__])
+    except (KeyError, TypeError):
+      return None
+    if path is None: return None
+    if path not in paths: paths.append(path)
+  return paths
+
+def replay_sources(model):
+  """
+  Returns the paths of model_sources(model) followed by those of the project
+  modules they import, directly or not, or None if model_sources(model) is
+  None. Replaying `model` runs code from any of them.
+  """
+  paths = model_sources(model)
+  if paths is None: return None
+  modules = [sys.modules[cls.__module__] for cls in inspect.getmro(model)
+      if cls is not object]
+  seen = set(module.__name__ for module in modules)
+  imported = set()
+  while modules:
+    # the modules a module imports, and those of the names it imports
+    for value in vars(modules.pop()).values():
+      if isinstance(value, types.ModuleType):
+        name = value.__name__
+      else:
+        name = getattr(value, "__module__", None)
+      if name in seen or sys.modules.get(name) is None: continue
+      seen.add(name)
+      try:
+        path = inspect.getsourcefile(sys.modules[name])
+      except TypeError: # a builtin module
+        continue
+      if path is None or not os.path.abspath(path).startswith(
+          PROJECT_DIR + os.sep):
+        continue
+      modules.append(sys.modules[name])
+      if path not in paths: imported.add(path)
+  return paths + sorted(imported)
+
+class Metrics(object):
+  """
+  Samples of a model's metrics, taken every `events` entries and/or every
+  `seconds` of trace time while it replays a trace, and once more after the
+  trace's end. Each sample records the index of the next entry, its timestamp,
+  the model's (unscaled) time, its live allocation count, and the value of each
+  metric it has set. Metrics first set after some samples were taken are NaN
+  in those samples.
+  """
+  def __init__(self, events=None, seconds=None):
+    if not events and not seconds:
+      raise ValueError("metrics need an event or a time interval")
+    self.events = events
+    self.seconds = seconds
+    self.indexes = array('l')
+    self.timestamps = array('d')
+    self.values = {"time": array('d'), "live_objects": array('d')}
+    self._end = (0, 0.0)
+
+  def names(self):
+    return ["time", "live_objects"] + sorted(set(self.values) -
+        set(["time", "live_objects"]))
+
+  def sampling(self, entries, model_inst):
+    """ Yields `entries`, sampling `model_inst` before each sample is due. """
+    events, seconds = self.events, self.seconds
+    next_index, next_time = 0, None
+    index, ts = -1, 0.0
+    for index, item in enumerate(entries):
+      ts = item['timestamp']
+      if seconds and next_time is None:
+        next_time = ts
+      if (events and index >= next_index) or \
+          (next_time is not None and ts >= next_time):
+        self.sample(index, ts, model_inst)
+        if events: next_index = index + events
+        if seconds:
+          next_time += (math.floor((ts - next_time) / seconds) + 1) * seconds
+      yield item
+    self._end = (index + 1, ts)
+
+  def finish(self, model_inst):
+    """ Takes the last sample, once the model is done with the trace. """
+    self.sample(self._end[0], self._end[1], model_inst)
+
+  def sample(self, index, ts, model_inst):
+    model_inst.sample_metrics()
+    self.indexes.append(index)
+    self.timestamps.append(ts)
+    self.values["time"].append(model_inst.get_time())
+    self.values["live_objects"].append(len(model_inst._metadata))
+    for name, value in model_inst.get_metrics().iteritems():
+      if name not in self.values:
+        self.values[name] = array('d', [float('nan')] * (len(self.indexes) - 1))
+      self.values[name].append(value)
+    for values in self.values.itervalues():
+      if len(values) < len(self.indexes): # no longer set
+        values.append(float('nan'))
+
+  def rows(self):
+    """ Yields the samples as (index, timestamp, value of each of names()). """
+    names = self.names()
+    for i in xrange(len(self.indexes)):
+      yield [self.indexes[i], self.timestamps[i]] + \
+          [self.values[name][i] for name in names]
+
 class TraceRunner(object):
-  def __init__(self, filename):
+  def __init__(self, filename, use_cache=True, progress=None, compact=False):
     self.models = []
     self.filename = filename
     self.data = None
+    self.scale = load_scale(filename)
+    self.use_cache = use_cache
+    self.progress = progress # a queue to put progress reports on, or None
+    self.compact = compact # keep the models' metadata in an AddrMap
+    self._stream = None # the msgpack trace file being streamed
 
   def load_data(self):
     if self.data: return
     self.data = json.load(open(self.filename, 'r'))
+    for item in self.data:
+      item['addr'] = tracefile.int_addr(item['addr'])
+
+  def entries(self):
+    """
+    Returns an iterable over the trace's entries: a generator reading a msgpack
+    trace incrementally, or the loaded json trace.
+    """
+    with open(self.filename, 'rb') as f:
+      is_msgpack, _ = tracefile.open_trace(f)
+    if is_msgpack:
+      return self._stream_entries()
+    self.load_data()
+    return self.data
+
+  def _stream_entries(self):
+    with open(self.filename, 'rb') as f:
+      self._stream = f
+      for item in tracefile.iter_trace(f, int_addrs=True):
+        yield item
+    self._stream = None
+
+  def _fraction_done(self, entries_done):
+    if self._stream is not None:
+      return self._stream.tell() / float(os.path.getsize(self.filename))
+    return entries_done / float(len(self.data)) if self.data else 1.0
+
+  def _reporting(self, entries, model, model_inst):
+    """
+    Yields `entries`, putting a progress report on self.progress after every
+    PROGRESS_INTERVAL of them have been replayed by `model_inst`.
+    """
+    name = model.__module__ + "." + model.__name__
+    entries = iter(entries)
+    done = 0
+    self.progress.put((self.filename, name, 0, 0.0, model_inst.get_time()))
+    while True:
+      chunk = list(itertools.islice(entries, PROGRESS_INTERVAL))
+      for item in chunk:
+        yield item
+      done += len(chunk)
+      fraction = self._fraction_done(done) \
+          if len(chunk) == PROGRESS_INTERVAL else 1.0
+      self.progress.put((self.filename, name, done, fraction,
+          model_inst.get_time()))
+      if len(chunk) < PROGRESS_INTERVAL: return
 
   def register(self, model):
     self.models.append(model)
 
   def run_one(self, model):
+    """
+    Returns the time `model` takes on the trace, from the result cache if the
+    model and the trace haven't changed since it was last run.
+    """
+    return self._cached(model, None, lambda: self._replay(model))
+
+  def run_metrics(self, model, events=None, seconds=None):
+    """
+    Returns the time `model` takes on the trace and a Metrics of its metrics
+    sampled every `events` entries and/or `seconds` of trace time.
+    """
+    def compute():
+      metrics = Metrics(events, seconds)
+      return self._replay(model, metrics), metrics
+    return self._cached(model, ("metrics", events, seconds), compute)
+
+  def _cached(self, model, params, compute):
+    """ Returns compute() for `model` and `params` through the result cache. """
+    sources = replay_sources(model) if self.use_cache else None
+    if sources is None:
+      return compute()
+
+    result_cache = cache.Cache()
+    key = result_cache.key("replay", REPLAY_VERSION,
+        model.__module__ + "." + model.__name__,
+        [result_cache.content_hash(path) for path in sources],
+        result_cache.content_hash(self.filename), self.scale, params)
+    return result_cache.memoize(key, compute)
+
+  def _replay(self, model, metrics=None):
     # TODO: Return better results!
     # Should seperate times by item name, bytes, etc.
-    self.load_data()
+    entries = self.entries()
     model_inst = model.__new__(model)
     model_inst.__init__()
-    for item in self.data:
+    if self.compact:
+      model_inst._metadata = AddrMap()
+    if self.progress is not None:
+      entries = self._reporting(entries, model, model_inst)
+    if metrics is not None:
+      entries = metrics.sampling(entries, model_inst)
+    if self.scale:
+      result = self._run_scaled(model_inst, entries)
+    else:
+      for item in entries:
+        item_type, addr = item['type'], item['addr']
+        ts, name, size = item['timestamp'], item['name'], item['bytes']
+        if item_type == ALLOC_TYPE:
+          model_inst._alloc(ts, addr, name, size)
+        elif item_type == FREE_TYPE:
+          model_inst._free(ts, addr, name, size)
+      model_inst._done()
+      result = model_inst.get_time()
+
+    if metrics is not None:
+      metrics.finish(model_inst)
+    return result
+
+  def _run_scaled(self, model_inst, entries):
+    """
+    Runs a sampled trace's `entries` through `model_inst`, scaling the time
+    spent on each entry by its label's sampling factor.
+    """
+    default, scale = self.scale
+    scaled_time = 0
+    for item in entries:
       item_type, addr = item['type'], item['addr']
       ts, name, size = item['timestamp'], item['name'], item['bytes']
+      before = model_inst.get_time()
       if item_type == ALLOC_TYPE:
         model_inst._alloc(ts, addr, name, size)
       elif item_type == FREE_TYPE:
         model_inst._free(ts, addr, name, size)
+      scaled_time += (model_inst.get_time() - before) * scale.get(name, default)
+
+    before = model_inst.get_time()
     model_inst._done()
-    return model_inst.get_time()
+    return scaled_time + (model_inst.get_time() - before) * default
 
   def run_all(self):
     proc_count = min(len(self.models), mp.cpu_count())
@@ -71,6 +359,7 @@ class GCModel(object):
   def __init__(self):
     self._time = 0
     self._metadata = {} # map addresses to returned allocation metadata
+    self._metrics = {} # map metric names to their current values
     self._validate_callbacks("talloc", "alloc", 3, 2)
     self._validate_callbacks("tfree", "free", 3, 2)
 
@@ -106,6 +395,24 @@ class GCModel(object):
   def get_time(self):
     return self._time
 
+  def set_gauge(self, name, value):
+    """ Sets the metric `name` to `value`, eg, the bytes held by the model. """
+    self._metrics[name] = value
+
+  def add_count(self, name, count=1):
+    """ Adds `count` to the metric `name`, eg, the number of pages fetched. """
+    self._metrics[name] = self._metrics.get(name, 0) + count
+
+  def get_metrics(self):
+    return self._metrics
+
+  def sample_metrics(self):
+    """
+    Called before the metrics are sampled. Models can override this to set
+    gauges that are cheaper to compute when sampled than to keep up to date.
+    """
+    pass
+
   def _alloc(self, ts, addr, name, size):
     # relies on _validate_callbacks being run before
     uses_simple = self._get_method("alloc") != None
@@ -118,12 +425,11 @@ class GCModel(object):
   def _free(self, ts, addr, name, size):
     # relies on _validate_callbacks being run before
     uses_simple = self._get_method("free") != None
-    metadata = self._metadata[addr]
+    metadata = self._metadata.pop(addr)
     if uses_simple:
       self.free(metadata)
     else:
       self.tfree(name, metadata)
-    del self._metadata[addr]
 
   def _done(self):
     if self._get_method("done") != None:
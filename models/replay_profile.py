@@ -0,0 +1,125 @@
+"""
+Profiles model replays with cProfile and summarizes the profiles (see
+runtrace.py --profile). Each (model, trace) replay is profiled in the worker
+that runs it and written to <directory>/<model>.<trace>.<hash>.prof (see
+run_name), which can be opened with pstats or any cProfile viewer.
+
+The summary splits each model's replay time between the framework (reading the
+trace and dispatching entries: gcmodel.py and the trace readers), the model's
+own modules, and other code. Builtins and library functions are not counted on
+their own; their time is split between the code calling them, in proportion to
+the time each caller spent in them, so eg, list.append called by a model counts
+as model time and json decoding called by TraceRunner as framework time.
+"""
+
+import os, hashlib, cProfile, pstats, gcmodel
+
+# the modules, by file name, that replay traces rather than model allocators
+FRAMEWORK_FILES = ["gcmodel.py", "runtrace.py", "replay_profile.py",
+    "tracefile.py", "umsgpack.py", "cache.py"]
+
+CATEGORIES = ["framework", "model", "other"]
+
+def run_name(model, filename):
+  """
+  Returns a file name stem for the replay of `model` on the trace `filename`:
+  <model>.<trace's base name>.<hash of its absolute path>, so traces with the
+  same name in different directories don't share one.
+  """
+  digest = hashlib.sha1(os.path.abspath(filename)).hexdigest()[:8]
+  return "%s.%s.%s" % (model, os.path.basename(filename), digest)
+
+def profile_path(directory, model, filename):
+  return os.path.join(directory, run_name(model, filename) + ".prof")
+
+def profile_call(path, function, *args):
+  """ Returns function(*args), writing its cProfile profile to `path`. """
+  profiler = cProfile.Profile()
+  try:
+    return profiler.runcall(function, *args)
+  finally:
+    profiler.dump_stats(path)
+
+def source_name(filename):
+  # compare file names only: the paths recorded in code objects depend on how
+  # the modules were imported and when their .pyc files were written
+  name = os.path.basename(filename)
+  return name[:-1] if name.endswith((".pyc", ".pyo")) else name
+
+def model_files(model):
+  """ Returns the file names of the modules defining `model`, if known. """
+  paths = gcmodel.model_sources(model) or []
+  return set(source_name(path) for path in paths) - set(FRAMEWORK_FILES)
+
+def categorize(stats, models):
+  """
+  Returns {category: seconds} of the time in the pstats.Stats `stats`, given
+  the file names `models` of the model modules.
+  """
+  framework = set(FRAMEWORK_FILES)
+  shares = {}
+
+  def share(func):
+    """ Returns {category: fraction} of the time spent in `func`. """
+    if func in shares: return shares[func]
+    name = source_name(func[0])
+    if name in models:
+      shares[func] = {"model": 1.0}
+    elif name in framework:
+      shares[func] = {"framework": 1.0}
+    else:
+      shares[func] = {"other": 1.0} # while following recursive calls
+      callers = stats.stats[func][4]
+      total = sum(c[2] for c in callers.values())
+      if total > 0:
+        result = {}
+        for caller, c in callers.items():
+          for category, fraction in share(caller).items():
+            result[category] = result.get(category, 0) + fraction * c[2] / total
+        shares[func] = result
+    return shares[func]
+
+  seconds = dict.fromkeys(CATEGORIES, 0.0)
+  for func, (_, _, tottime, _, _) in stats.stats.items():
+    for category, fraction in share(func).items():
+      seconds[category] += tottime * fraction
+  return seconds, share
+
+def summarize(directory, paths, model_classes, top=20):
+  """
+  Prints how each model's replays split their time by category and the `top`
+  functions over all replays, and writes the merged profile to
+  <directory>/merged.prof. `paths` maps each model's import path to its
+  profile files and `model_classes` maps it to the model class.
+  """
+  files = set()
+  for cls in model_classes.values():
+    files |= model_files(cls)
+
+  print "Profiles in", directory
+  print "%-32s %18s %18s %18s" % tuple(["model"] + CATEGORIES)
+  merged = None
+  for model in sorted(paths):
+    stats = pstats.Stats(*paths[model])
+    seconds, _ = categorize(stats, model_files(model_classes[model]))
+    total = sum(seconds.values()) or 1.0
+    print "%-32s %s" % (model, " ".join("%10.2fs (%3d%%)" %
+        (seconds[c], 100 * seconds[c] / total) for c in CATEGORIES))
+    if merged is None:
+      merged = pstats.Stats(*paths[model])
+    else:
+      merged.add(*paths[model])
+  if merged is None: return
+
+  merged.dump_stats(os.path.join(directory, "merged.prof"))
+  _, share = categorize(merged, files)
+  print
+  print "Top functions of all replays by own time:"
+  print "%10s %10s %10s  %-10s %s" % ("tottime", "cumtime", "calls",
+      "category", "function")
+  rows = sorted(merged.stats.items(), key=lambda item: -item[1][2])
+  for func, (_, calls, tottime, cumtime, _) in rows[:top]:
+    shares = share(func)
+    category = max(shares, key=shares.get)
+    print "%10.3f %10.3f %10d  %-10s %s" % (tottime, cumtime, calls,
+        category, pstats.func_std_string(func))
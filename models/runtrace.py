@@ -1,32 +1,299 @@
 #!/usr/bin/python
-import argparse, gcmodel, importlib, string
+"""
+Runs one or more models on one or more filtered traces and prints a table of
+the time each model took on each trace, relative to a baseline model:
+
+  ./runtrace.py -m simple_malloc.SimpleMalloc trace.json
+  ./runtrace.py trace1.json trace2.msgpack --baseline slab.SlabAllocatorFamily
+  ./runtrace.py -m simple_malloc.SimpleMalloc -m slab.SlabAllocatorFamily \
+      *.json --csv results.csv
+
+The (model x trace) matrix runs on a process pool. The largest traces are
+scheduled first so that a big trace doesn't start last and hold up the run,
+and each trace's models are scheduled together: every worker keeps the last
+trace it loaded, so it loads each trace once instead of once per model.
+corpus.py runs models on weighted corpora of traces from several workloads.
+Results are cached by gcmodel.TraceRunner, so only the models and traces that
+changed since the last run are replayed (--no-cache replays everything).
+
+While the models run, a status line on standard error shows each running
+replay's progress through its trace, its speed, an ETA and the model's time so
+far, from reports the workers send every gcmodel.PROGRESS_INTERVAL entries.
+It is only shown when standard error is a terminal, or not at all with
+--no-progress.
+
+With --profile DIR, each replay is profiled with cProfile into DIR (see
+replay_profile.py), and a summary of where each model's time went is printed
+after the results.
+
+With --metrics DIR, each model's metrics (see gcmodel.Metrics) are sampled
+every --sample-events entries or --sample-seconds of trace time and written to
+DIR/<model>.<trace>.<hash>.csv (named like the profiles), one row per sample.
+
+With --compact-metadata, the models' allocation metadata is kept in an AddrMap
+(see addrmap.py) rather than a dict, for traces with too many live allocations
+to replay in memory otherwise. Replays take longer with it.
+"""
+
+import os, sys, argparse, csv, gcmodel, importlib, string, threading, time
+import replay_profile
+import multiprocessing as mp
+
+# the import paths of the models to run when none are given (eg, by
+# scripts/bench_pipeline.py). add new models here.
+MODELS = [
+  "simple_malloc.SimpleMalloc",
+  "slab.SlabAllocatorFamily",
+]
+
+def load_model(path):
+  """ Imports and returns the model class at `path`, eg, slab.SlabAllocatorFamily """
+  splits = path.split(".")
+  module, name = splits[0], string.join(splits[1:], ".")
+  module = importlib.import_module(module)
+  return getattr(module, name)
+
+def check_models(parser, models):
+  """ Exits with a usage error from `parser` if a model can't be loaded. """
+  for model in models:
+    try:
+      load_model(model)
+    except ImportError as e:
+      parser.error("could not import module: " + str(e))
+    except AttributeError as e:
+      parser.error("couldn't find the model: " + str(e))
+    except:
+      parser.error("the model path is not valid: " + model)
+
+# the TraceRunner of the trace this process ran a model on last
+_runner = None
+# the queue this process puts progress reports on, if any
+_progress = None
+
+def init_worker(progress):
+  global _progress
+  _progress = progress
+
+def run_task(task):
+  """ Runs the model at import path `model` on the trace `filename`. """
+  global _runner
+  model, filename, use_cache, profile_dir, sampling, compact = task
+  if _runner is None or _runner.filename != filename:
+    _runner = None # let the previous trace be freed before loading this one
+    _runner = gcmodel.TraceRunner(filename, use_cache, _progress, compact)
+
+  if sampling:
+    run, args = _runner.run_metrics, (load_model(model),) + sampling
+  else:
+    run, args = _runner.run_one, (load_model(model),)
+  if profile_dir:
+    path = replay_profile.profile_path(profile_dir, model, filename)
+    result = replay_profile.profile_call(path, run, *args)
+  else:
+    result = run(*args)
+  time, metrics = result if sampling else (result, None)
+  return model, filename, time, metrics
+
+class StatusLine(object):
+  """
+  Shows the progress reports put on `queue` by the workers (see gcmodel.py) as
+  a line on standard error, redrawn at most every `interval` seconds.
+  """
+  def __init__(self, queue, tasks, interval=0.5):
+    self.queue = queue
+    self.tasks = tasks
+    self.interval = interval
+    self.finished = set()
+    self.running = {} # (model, trace) -> (start, entries, fraction, time)
+    self.width = 0
+    self.drawn = 0
+    self.lock = threading.Lock()
+    self.thread = threading.Thread(target=self._read)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _read(self):
+    while True:
+      report = self.queue.get()
+      if report is None: return
+      filename, model, entries, fraction, model_time = report
+      with self.lock:
+        # a worker's last reports may arrive after its result
+        if (model, filename) in self.finished: continue
+        start = self.running.get((model, filename), (time.time(),))[0]
+        self.running[(model, filename)] = \
+            (start, entries, fraction, model_time)
+        self._draw()
+
+  def finish(self, model, filename):
+    with self.lock:
+      self.running.pop((model, filename), None)
+      self.finished.add((model, filename))
+      self._draw()
+
+  def close(self):
+    self.queue.put(None)
+    self.thread.join()
+    sys.stderr.write("\r" + " " * self.width + "\r")
+
+  def _draw(self):
+    now = time.time()
+    if now - self.drawn < self.interval: return
+    self.drawn = now
+
+    parts = ["%d/%d done" % (len(self.finished), self.tasks)]
+    for (model, filename), report in sorted(self.running.items()):
+      start, entries, fraction, model_time = report
+      elapsed = max(now - start, 1e-6)
+      eta = "%.0fs" % (elapsed * (1 - fraction) / fraction) if fraction else "?"
+      parts.append("%s %s %d%% %d ev/s ETA %s time %.2f" % (
+          model.split(".")[-1], os.path.basename(filename), 100 * fraction,
+          entries / elapsed, eta, model_time))
+    line = " | ".join(parts)
+    sys.stderr.write("\r" + line.ljust(self.width))
+    sys.stderr.flush()
+    self.width = len(line)
+
+def run_matrix(models, filenames, jobs, use_cache=True, progress=False,
+    profile_dir=None, sampling=None, compact=False):
+  """
+  Runs every model on every trace with `jobs` processes. Returns maps from
+  (model, trace) to the model's time on the trace and to its sampled metrics,
+  if `sampling` is an (events, seconds) interval (see gcmodel.Metrics). With
+  `progress`, shows a status line while they run. With `profile_dir`, profiles
+  each run into it. With `compact`, keeps the models' metadata in AddrMaps.
+  """
+  filenames = sorted(filenames, key=os.path.getsize, reverse=True)
+  tasks = [(model, filename, use_cache, profile_dir, sampling, compact)
+      for filename in filenames for model in models]
+  queue = mp.Queue() if progress else None
+  status = StatusLine(queue, len(tasks)) if progress else None
+
+  if jobs <= 1:
+    init_worker(queue)
+    results = (run_task(task) for task in tasks)
+  else:
+    # a chunk is one trace's models, so a single worker loads the trace
+    pool = mp.Pool(processes=min(jobs, len(filenames)), initializer=init_worker,
+        initargs=(queue,))
+    results = pool.imap_unordered(run_task, tasks, chunksize=len(models))
+
+  times, metrics = {}, {}
+  for model, filename, time, samples in results:
+    times[(model, filename)] = time
+    if samples is not None: metrics[(model, filename)] = samples
+    if status: status.finish(model, filename)
+  if jobs > 1:
+    pool.close()
+    pool.join()
+  if status: status.close()
+  return times, metrics
+
+def relative(results, model, filename, baseline):
+  base = results[(baseline, filename)]
+  return results[(model, filename)] / float(base) if base else float('nan')
+
+def print_table(results, models, filenames, baseline):
+  cells = [["trace"] + models]
+  for filename in filenames:
+    cells.append([filename] + ["%.2f (%.2fx)" % (results[(m, filename)],
+        relative(results, m, filename, baseline)) for m in models])
+
+  widths = [max(len(row[i]) for row in cells) for i in range(len(cells[0]))]
+  print "Relative to", baseline
+  for row in cells:
+    print "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+
+def write_csv(filename, results, models, filenames, baseline):
+  with open(filename, 'w') as f:
+    writer = csv.writer(f)
+    writer.writerow(["trace", "model", "time", "relative_to_" + baseline])
+    for trace in filenames:
+      for model in models:
+        writer.writerow([trace, model, results[(model, trace)],
+            relative(results, model, trace, baseline)])
+
+def write_metrics(directory, metrics):
+  """ Writes each run's sampled metrics to <directory>/<run name>.csv """
+  for (model, trace), samples in metrics.items():
+    filename = os.path.join(directory,
+        replay_profile.run_name(model, trace) + ".csv")
+    with open(filename, 'w') as f:
+      writer = csv.writer(f)
+      writer.writerow(["index", "timestamp"] + samples.names())
+      writer.writerows(samples.rows())
 
 def parse_args():
   parser = argparse.ArgumentParser()
-  parser.add_argument("model", type=str,
-      help="the full import path of the model to run the trace on." +
-      " example: simple_malloc.SimpleMalloc")
-  parser.add_argument("filename", metavar="trace.json", type=str,
-      help="filename for filtered trace json. required")
+  parser.add_argument("filenames", metavar="trace.json", type=str, nargs="+",
+      help="filenames for filtered trace json or msgpack. required")
+  parser.add_argument("-m", "--model", dest="models", action="append",
+      help="the full import path of a model to run the traces on. may be" +
+      " repeated. example: simple_malloc.SimpleMalloc (all of MODELS)")
+  parser.add_argument("--baseline", type=str, default=None,
+      help="the model the others are compared to (the first model)")
+  parser.add_argument("-j", "--jobs", type=int, default=mp.cpu_count(),
+      help="number of processes to run the models with (cpu count)")
+  parser.add_argument("--csv", type=str, default=None,
+      help="also write the results to this csv file")
+  parser.add_argument("--no-cache", dest="use_cache", action="store_false",
+      help="don't read or write the result cache ($AUTOGC_CACHE_DIR)")
+  parser.add_argument("--no-progress", dest="progress", action="store_false",
+      help="don't show a status line, even on a terminal")
+  parser.add_argument("--profile", metavar="DIR", type=str, default=None,
+      help="profile each run with cProfile into DIR and print a summary. "
+      "implies --no-cache")
+  parser.add_argument("--metrics", metavar="DIR", type=str, default=None,
+      help="sample each model's metrics while it runs and write them to DIR")
+  parser.add_argument("--sample-events", type=int, default=None,
+      help="with --metrics, sample every SAMPLE_EVENTS entries (10000 unless "
+      "--sample-seconds is given)")
+  parser.add_argument("--sample-seconds", type=float, default=None,
+      help="with --metrics, sample every SAMPLE_SECONDS of trace time")
+  parser.add_argument("--compact-metadata", dest="compact", action="store_true",
+      help="keep the models' allocation metadata in a compact but slower "
+      "AddrMap instead of a dict")
   args = parser.parse_args()
 
-  try:
-    splits = args.model.split(".")
-    module, name = splits[0], string.join(splits[1:], ".")
-    module = importlib.import_module(module)
-    args.model = getattr(module, name)
-  except ImportError as e:
-    parser.error("could not import module: " + str(e))
-  except AttributeError as e:
-    parser.error("couldn't find the model: " + str(e))
-  except:
-    parser.error("the model path is not valid")
+  args.models = args.models or list(MODELS)
+  args.baseline = args.baseline or args.models[0]
+  if args.baseline not in args.models:
+    args.models.append(args.baseline)
+  check_models(parser, args.models)
+
+  for filename in args.filenames:
+    if not os.path.isfile(filename):
+      parser.error("no such trace: " + filename)
+
+  args.progress = args.progress and sys.stderr.isatty()
+  if args.profile:
+    args.use_cache = False # a cached result has nothing to profile
+    if not os.path.isdir(args.profile):
+      os.makedirs(args.profile)
 
+  args.sampling = None
+  if args.metrics:
+    if not args.sample_events and not args.sample_seconds:
+      args.sample_events = 10000
+    args.sampling = (args.sample_events, args.sample_seconds)
+    if not os.path.isdir(args.metrics):
+      os.makedirs(args.metrics)
+  elif args.sample_events or args.sample_seconds:
+    parser.error("--sample-events and --sample-seconds need --metrics")
   return args
 
 if __name__ == "__main__":
   args = parse_args()
-  runner = gcmodel.TraceRunner(args.filename)
-  runner.register(args.model)
-  results = runner.run_all()
-  print results
+  results, metrics = run_matrix(args.models, args.filenames, args.jobs,
+      args.use_cache, args.progress, args.profile, args.sampling, args.compact)
+  print_table(results, args.models, args.filenames, args.baseline)
+  if args.csv:
+    write_csv(args.csv, results, args.models, args.filenames, args.baseline)
+  if args.metrics:
+    write_metrics(args.metrics, metrics)
+  if args.profile:
+    print
+    replay_profile.summarize(args.profile,
+        {model: [replay_profile.profile_path(args.profile, model, filename)
+            for filename in args.filenames] for model in args.models},
+        {model: load_model(model) for model in args.models})
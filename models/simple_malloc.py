@@ -65,6 +65,7 @@ class SimpleMalloc(gcmodel.GCModel):
     num = math.ceil(float(num_bytes) / Consts.page_size.value)
     self.memory_left += num * Consts.page_size.value
     self.add_time(num * Consts.page_fetch_time.value)
+    self.add_count("pages_fetched", num)
     return num
 
   def get_chunk(self, size):
@@ -93,11 +94,16 @@ class SimpleMalloc(gcmodel.GCModel):
 
     self.free_chunks.append(chunk_size)
     self.memory_left -= chunk_size;
+    self.add_count("chunks_created")
     return chunk_size
 
   def free_memory(self):
     return self.memory_left + sum(self.free_chunks)
 
+  def sample_metrics(self):
+    self.set_gauge("free_chunks", len(self.free_chunks))
+    self.set_gauge("free_bytes", self.free_memory())
+
   def reclaim_space(self):
     return
     # """ Reclaims any contiguous pages such that at least the initial amount
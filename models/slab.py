@@ -43,6 +43,7 @@ class SlabAllocatorFamily(gcmodel.GCModel):
     """ Fetches enough pages to have at least `num_bytes` of free memory. """
     num = math.ceil(float(num_bytes) / Consts.page_size.value)
     self.add_time(num * Consts.page_fetch_time.value)
+    self.add_count("pages_fetched", num)
     return num
 
   def get_allocator(self, type_name, obj_size):
@@ -63,6 +64,16 @@ class SlabAllocatorFamily(gcmodel.GCModel):
     allocator = self.get_allocator(name, size)
     return allocator.free()
 
+  def sample_metrics(self):
+    capacity, allocated = 0, 0
+    for (name, obj_size), allocator in self.allocators.iteritems():
+      cap, alloc = allocator.stats()
+      capacity += cap * obj_size
+      allocated += alloc * obj_size
+    self.set_gauge("slabs", len(self.allocators))
+    self.set_gauge("capacity_bytes", capacity)
+    self.set_gauge("allocated_bytes", allocated)
+
   def done(self):
     total_capacity, total_mem = 0, 0
     for (name, obj_size) in self.allocators:
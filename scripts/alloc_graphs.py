@@ -2,17 +2,22 @@
 """
 This script generates a graph for each object type from a filtered mtrace json
 file where the x-axis is time and the y-axis is number of allocations.
+
+The counts are computed for all labels at once with NumPy and each series is
+downsampled to a point budget (--points) before plotting, keeping the minimum
+and maximum of every time bucket so that spikes aren't lost. The counts are
+cached on disk by the trace's content hash (see cache.py), so re-running the
+script on the same trace only re-plots. With --summary, the script only writes
+per-label statistics to a JSON or CSV file and never imports matplotlib, which
+keeps batch runs over many traces fast.
 """
 
 from __future__ import print_function
 
-# force matplotlib to not use any xwindows backend.
-import matplotlib
-matplotlib.use('Agg')
-
-import sys, json, os, argparse, itertools
+import sys, json, os, argparse, itertools, array
+import multiprocessing as mp
+import tracefile, cache, plotting
 import numpy as np
-import matplotlib.pyplot as plt
 
 # global constants
 BAD_FREE_TYPE = -1
@@ -22,33 +27,66 @@ ALLOC_TYPE = 1
 def printerr(*args):
   print(*args, file=sys.stderr)
 
-def get_prev_count(grouped, item):
-  name = item['name']
-  if name in grouped:
-    y_vals = grouped[name][1]
-    return 0 if len(y_vals) < 1 else y_vals[-1]
-  return 0
-
-def handle_item(grouped, item):
-  # only deal with valid types
-  if item['type'] < 0: return
-
-  # create the initial values if needed
-  name = item['name']
-  if name not in grouped:
-    grouped[name] = ([], [])
-
-  # get the previous number of allocs, insert the new
-  prev_count = get_prev_count(grouped, item)
-  x_vals, y_vals = grouped[name]
-  x_vals.append(item['timestamp'])
-  if item['type'] == ALLOC_TYPE:
-    y_vals.append(prev_count + 1)
+# Returns a map from label name to (x-values, y-values) arrays where x-values
+# are time and y-values are the number of live allocations at that time. The
+# counts of all labels are computed with a single stable sort by label and one
+# cumulative sum of +1 (alloc) / -1 (free).
+def group_counts_by_name(data):
+  strings = tracefile.StringTable()
+  ids, times, deltas = array.array('i'), array.array('d'), array.array('b')
+  for item in data:
+    # only deal with valid types
+    if item['type'] < 0: continue
+
+    ids.append(strings.intern(item['name']))
+    times.append(item['timestamp'])
+    deltas.append(1 if item['type'] == ALLOC_TYPE else -1)
+
+  ids = np.frombuffer(ids, dtype=np.intc)
+  times = np.frombuffer(times, dtype=np.float64)
+  deltas = np.frombuffer(deltas, dtype=np.int8).astype(np.int64)
+
+  # a stable sort keeps each label's entries in time order
+  order = np.argsort(ids, kind='mergesort')
+  ids, times, deltas = ids[order], times[order], deltas[order]
+  label_ids, starts, counts = np.unique(ids, return_index=True,
+      return_counts=True)
+
+  # restart the running total at the beginning of each label
+  totals = np.cumsum(deltas)
+  live = totals - np.repeat(totals[starts] - deltas[starts], counts)
+
+  return {strings[i]: (times[s:s + c], live[s:s + c])
+      for i, s, c in zip(label_ids, starts, counts)}
+
+# Reduces the series to at most `points` points for plotting. The time range is
+# split into points / 4 equal-width buckets (think pixels) and only the first,
+# last, lowest and highest point of each bucket is kept, which preserves the
+# shape of the line as it is drawn.
+def downsample(x_vals, y_vals, points):
+  n = len(x_vals)
+  if n <= points: return x_vals, y_vals
+
+  num_buckets = max(points // 4, 1)
+  span = x_vals[-1] - x_vals[0]
+  if span > 0:
+    buckets = ((x_vals - x_vals[0]) / span * num_buckets).astype(int)
+    buckets = np.minimum(buckets, num_buckets - 1)
   else:
-    y_vals.append(prev_count - 1)
+    buckets = np.zeros(n, dtype=int)
+
+  # x-values are sorted, so each bucket is a contiguous range of indices
+  firsts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+  lasts = np.r_[firsts[1:], n] - 1
+  by_value = np.lexsort((y_vals, buckets))
+  lows, highs = by_value[firsts], by_value[lasts]
+
+  keep = np.unique(np.concatenate((firsts, lasts, lows, highs)))
+  return x_vals[keep], y_vals[keep]
 
 def generate_graph(name, (x_vals, y_vals)):
   print("Generating graph for", name)
+  plt = plotting.pyplot()
 
   fig, ax1 = plt.subplots()
   ax1.set_title("'" + name + "' Allocations Over Time")
@@ -59,6 +97,7 @@ def generate_graph(name, (x_vals, y_vals)):
   plt.setp(lines, aa=False, ls='steps', c='black')
 
   plt.savefig(name + "_allocs_time.pdf")
+  plt.close(fig)
 
 # remove entries with < num values
 def filter_low(grouped, num):
@@ -74,6 +113,7 @@ def filter_low(grouped, num):
 def generate_union_graph(grouped):
   # TODO: Seperate this into four graphs by max number of allocs in quartiles
   print("Generating union graph")
+  plt = plotting.pyplot()
 
   fig, ax1 = plt.subplots()
   ax1.set_title("Allocations Over Time")
@@ -95,31 +135,76 @@ def generate_union_graph(grouped):
     columnspacing=1.0, labelspacing=0.0,
     handletextpad=0.0, handlelength=1.5)
   plt.savefig("all_allocs_time.pdf")
-
-
-def main(data):
-  # map from label name to a ([x-values], [y-values])
-  # where x-values are time and y-values are number of allocs at that time
-  grouped = {}
-  for item in data:
-    handle_item(grouped, item)
+  plt.close(fig)
+
+# bump whenever the output of group_counts_by_name changes
+ANALYSIS_VERSION = 1
+
+# Returns the live counts of the filtered trace in the file `f`. Results are
+# cached by the trace's content hash, so later runs on the same trace skip
+# parsing it.
+def load_counts(f, use_cache=True):
+  def compute():
+    return group_counts_by_name(tracefile.iter_trace(f))
+
+  if not use_cache or not os.path.isfile(f.name):
+    return compute()
+  analysis_cache = cache.Cache()
+  key = analysis_cache.key("alloc_graphs", ANALYSIS_VERSION,
+      analysis_cache.content_hash(f.name))
+  return analysis_cache.memoize(key, compute)
+
+SUMMARY_FIELDS = ["label", "events", "allocs", "frees", "peak_live",
+    "peak_time", "final_live", "first_time", "last_time"]
+
+# Returns a row of live count statistics for each label.
+def summarize(grouped):
+  rows = []
+  for name in sorted(grouped):
+    x_vals, y_vals = grouped[name]
+    if not len(x_vals): continue
+    peak = np.argmax(y_vals)
+    # the live count goes up by one on each alloc and down by one on each free
+    allocs = (len(y_vals) + y_vals[-1]) // 2
+    rows.append({"label": name, "events": len(x_vals), "allocs": allocs,
+        "frees": len(x_vals) - allocs, "peak_live": y_vals[peak],
+        "peak_time": x_vals[peak], "final_live": y_vals[-1],
+        "first_time": x_vals[0], "last_time": x_vals[-1]})
+  return rows
+
+def main(grouped, jobs=1, points=2000):
 
   # remove those with too few entries
   filter_low(grouped, 15)
 
-  # plot each individually
+  # only plot as many points as can be told apart
   for name in grouped:
-    generate_graph(name, grouped[name])
+    grouped[name] = downsample(grouped[name][0], grouped[name][1], points)
 
-  # plot them all together
-  generate_union_graph(grouped)
+  # plot them all together, alongside each one individually
+  figures = [(generate_union_graph, (grouped,))]
+  for name in grouped:
+    figures.append((generate_graph, (name, grouped[name])))
+  plotting.render_all(figures, jobs)
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
   parser.add_argument("filename", nargs="?", metavar="filtered.json",
       type=argparse.FileType('r'), default=sys.stdin,
-      help="filename for filtered json. leave empty to use standard input")
+      help="filename for filtered json or msgpack. leave empty to use "
+      "standard input")
+  parser.add_argument("-j", "--jobs", type=int, default=mp.cpu_count(),
+      help="number of processes to render figures with (cpu count)")
+  parser.add_argument("--points", type=int, default=2000,
+      help="maximum number of points plotted per label (2000)")
+  parser.add_argument("--no-cache", dest="use_cache", action="store_false",
+      help="don't read or write the analysis cache ($AUTOGC_CACHE_DIR)")
+  parser.add_argument("--summary", type=str, default=None, metavar="FILE",
+      help="only write per-label statistics to FILE (.csv or .json, - for "
+      "stdout) instead of plotting")
 
   args = parser.parse_args()
-  data = json.load(args.filename)
-  sys.exit(main(data))
+  grouped = load_counts(args.filename, args.use_cache)
+  if args.summary:
+    sys.exit(plotting.write_summary(summarize(grouped), SUMMARY_FIELDS, args.summary))
+  sys.exit(main(grouped, args.jobs, args.points))
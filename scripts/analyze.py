@@ -0,0 +1,345 @@
+#!/usr/bin/python
+"""
+This script computes any set of metrics over a filtered mtrace json file (the
+output of filter.py) in a single streaming pass, instead of one pass (and one
+script) per question. The available metrics are:
+
+  1) lifetimes: each label's object lifetimes (ms), sorted.
+  2) live_counts: each label's number of live objects over time.
+  3) live_bytes: the total and each label's number of live bytes over time,
+     with the peaks (see working_set.py).
+  4) size_histogram: each label's allocation sizes in power-of-two buckets.
+  5) alloc_rate: each label's number of allocations per time interval, for
+     the intervals it allocates in.
+  6) peak_working_set: the global and each label's peak number of live bytes,
+     and when they're reached.
+
+The trace is read in chunks of columns (timestamps, types, sizes, label ids,
+addresses) which are handed to each requested metric. Metrics that need whole
+columns share one copy of the columns they need, and peak_working_set is taken
+from the live_bytes results rather than computed again. The results are written
+to a compressed NumPy bundle (.npz) that the plotting and reporting tools can
+load with load_bundle without touching the trace again:
+
+  ./analyze.py filtered.json -o results.npz
+  ./analyze.py filtered.json -m lifetimes -m live_bytes -o results.npz
+
+Per-label series are stored flattened: the values of labels[i] are
+values[starts[i]:starts[i] + counts[i]]. alloc_rate is stored sparsely, with
+the interval index of each value in `bins`; densify expands a label's series.
+"""
+
+from __future__ import print_function
+import sys, argparse, array, collections
+import numpy as np
+import tracefile, working_set
+
+# global constants
+BAD_FREE_TYPE = -1
+FREE_TYPE = 0
+ALLOC_TYPE = 1
+
+# number of power-of-two size buckets: bucket b holds sizes in (2^(b-1), 2^b]
+SIZE_BUCKETS = 33
+
+def printerr(*args):
+  print(*args, file=sys.stderr)
+
+Chunk = collections.namedtuple("Chunk", "times kinds sizes labels addrs")
+DTYPES = Chunk(np.float64, np.int8, np.int_, np.intc, np.uint)
+
+def read_chunks(data, strings, chunk_size=1 << 16):
+  """
+  Yields the valid (alloc and free) entries of the filtered trace `data` as
+  Chunks of up to `chunk_size` entries, with label names interned in `strings`.
+  """
+  def empty():
+    return (array.array('d'), array.array('b'), array.array('l'),
+        array.array('i'), array.array('L'))
+
+  def to_chunk(columns):
+    return Chunk(*[np.frombuffer(c, dtype=dtype)
+        for c, dtype in zip(columns, DTYPES)])
+
+  columns = empty()
+  times, kinds, sizes, labels, addrs = columns
+  for item in data:
+    if item['type'] == BAD_FREE_TYPE: continue
+    times.append(item['timestamp'])
+    kinds.append(item['type'])
+    sizes.append(item['bytes'])
+    labels.append(strings.intern(item['name']))
+    addrs.append(tracefile.parse_addr(item['addr']))
+    if len(times) == chunk_size:
+      yield to_chunk(columns)
+      columns = empty()
+      times, kinds, sizes, labels, addrs = columns
+
+  if len(times): yield to_chunk(columns)
+
+class Columns(object):
+  """ Accumulates named NumPy columns across chunks. """
+  def __init__(self, *names):
+    self.parts = {name: [] for name in names}
+
+  def append(self, **columns):
+    for name, values in columns.items():
+      self.parts[name].append(values)
+
+  def get(self, name, dtype):
+    parts = self.parts[name]
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=dtype)
+
+class Metric(object):
+  """
+  A metric consumes the trace chunk by chunk and returns its results as a
+  dict of NumPy arrays from finish. Results indexed by label refer to the ids
+  of the engine's StringTable.
+
+  Rather than keeping its own copy of the trace, a metric lists the Chunk
+  `fields` it needs whole and gets them in finish as a Chunk of the whole
+  trace, kept once for all metrics. A metric computed from the results of
+  others lists their names in `requires` and gets them in finish too.
+  """
+  name = None
+  fields = ()
+  requires = ()
+
+  def consume(self, chunk):
+    pass
+
+  def finish(self, num_labels, trace, results):
+    raise NotImplementedError
+
+class Lifetimes(Metric):
+  name = "lifetimes"
+  fields = ("times", "kinds", "labels", "addrs")
+
+  def finish(self, num_labels, trace, results):
+    # in address order (stable, so in time order per address), a free right
+    # after an alloc of the same address is that allocation's free
+    order = np.argsort(trace.addrs, kind='mergesort')
+    times, kinds = trace.times[order], trace.kinds[order]
+    labels, addrs = trace.labels[order], trace.addrs[order]
+    paired = ((kinds[:-1] == ALLOC_TYPE) & (kinds[1:] == FREE_TYPE) &
+        (addrs[:-1] == addrs[1:]))
+    allocs = np.flatnonzero(paired)
+    lifetimes = (times[allocs + 1] - times[allocs]) * 10**3
+
+    labels = labels[allocs]
+    order = np.lexsort((lifetimes, labels))
+    label_ids, starts, counts = np.unique(labels[order], return_index=True,
+        return_counts=True)
+    return {"labels": label_ids, "starts": starts, "counts": counts,
+        "values": lifetimes[order]}
+
+class LiveSeries(Metric):
+  """ Each label's running total of a per-entry delta over time. """
+  fields = ("times", "kinds", "labels")
+
+  def deltas(self, trace):
+    raise NotImplementedError
+
+  def finish(self, num_labels, trace, results):
+    label_ids, starts, counts, times, deltas = working_set.group_by_label(trace.labels,
+        trace.times, self.deltas(trace))
+    return {"labels": label_ids, "starts": starts, "counts": counts,
+        "times": times, "values": working_set.running_totals(starts, counts, deltas)}
+
+class LiveCounts(LiveSeries):
+  name = "live_counts"
+
+  def deltas(self, trace):
+    return np.where(trace.kinds == ALLOC_TYPE, 1, -1).astype(np.int64)
+
+class LiveBytes(LiveSeries):
+  name = "live_bytes"
+  fields = LiveSeries.fields + ("sizes",)
+
+  def deltas(self, trace):
+    return np.where(trace.kinds == ALLOC_TYPE, trace.sizes, -trace.sizes)
+
+  def finish(self, num_labels, trace, results):
+    return working_set.working_set(trace.times, trace.labels, self.deltas(trace))
+
+class PeakWorkingSet(Metric):
+  name = "peak_working_set"
+  requires = ("live_bytes",)
+
+  def finish(self, num_labels, trace, results):
+    fields = ["labels", "peaks", "peak_times", "peak", "peak_time"]
+    return {field: results["live_bytes"][field] for field in fields}
+
+class SizeHistogram(Metric):
+  name = "size_histogram"
+
+  def __init__(self):
+    self.counts = np.zeros((0, SIZE_BUCKETS), dtype=np.int64)
+
+  def consume(self, chunk):
+    allocs = chunk.kinds == ALLOC_TYPE
+    labels, sizes = chunk.labels[allocs], chunk.sizes[allocs]
+    buckets = np.ceil(np.log2(np.maximum(sizes, 1))).astype(int)
+    buckets = np.minimum(buckets, SIZE_BUCKETS - 1)
+
+    rows = labels.max() + 1 if len(labels) else 0
+    if rows > len(self.counts):
+      grown = np.zeros((rows, SIZE_BUCKETS), dtype=np.int64)
+      grown[:len(self.counts)] = self.counts
+      self.counts = grown
+    np.add.at(self.counts, (labels, buckets), 1)
+
+  def finish(self, num_labels, trace, results):
+    counts = np.zeros((num_labels, SIZE_BUCKETS), dtype=np.int64)
+    counts[:len(self.counts)] = self.counts
+    return {"bucket_limits": 2**np.arange(SIZE_BUCKETS), "counts": counts}
+
+class AllocRate(Metric):
+  name = "alloc_rate"
+
+  def __init__(self, interval=1.0):
+    self.interval = interval
+    self.start = None
+    # each chunk's allocs by label << 32 | interval index
+    self.columns = Columns("keys", "allocs")
+
+  def consume(self, chunk):
+    allocs = chunk.kinds == ALLOC_TYPE
+    if self.start is None and len(chunk.times):
+      self.start = chunk.times[0]
+    labels, times = chunk.labels[allocs], chunk.times[allocs]
+    bins = ((times - self.start) // self.interval).astype(np.int64)
+    keys, allocs = np.unique(labels.astype(np.int64) << 32 | bins,
+        return_counts=True)
+    self.columns.append(keys=keys, allocs=allocs)
+
+  def finish(self, num_labels, trace, results):
+    # sum the chunks' counts of the intervals that span chunks
+    keys, inverse = np.unique(self.columns.get("keys", np.int64),
+        return_inverse=True)
+    allocs = np.bincount(inverse, weights=self.columns.get("allocs", np.int64),
+        minlength=len(keys)).astype(np.int64)
+    # the keys are sorted by label, then by interval
+    label_ids, starts, counts = np.unique(keys >> 32, return_index=True,
+        return_counts=True)
+    return {"start": np.array(self.start or 0.0),
+        "interval": np.array(self.interval), "labels": label_ids,
+        "starts": starts, "counts": counts, "bins": keys & 0xffffffff,
+        "values": allocs}
+
+def densify(result, label):
+  """
+  Returns the number of allocations of `label` in each interval up to its
+  last, from the alloc_rate `result`, as a dense array.
+  """
+  i = np.searchsorted(result["labels"], label)
+  if i == len(result["labels"]) or result["labels"][i] != label:
+    return np.zeros(0, dtype=np.int64)
+  series = slice(result["starts"][i], result["starts"][i] + result["counts"][i])
+  bins = result["bins"][series]
+  rates = np.zeros(bins[-1] + 1, dtype=np.int64)
+  rates[bins] = result["values"][series]
+  return rates
+
+# in an order where each metric comes after the ones it requires
+METRICS = collections.OrderedDict((m.name, m) for m in [Lifetimes, LiveCounts,
+    LiveBytes, SizeHistogram, AllocRate, PeakWorkingSet])
+
+def analyze(data, metrics):
+  """
+  Runs the Metric instances `metrics` over the filtered trace `data` in one
+  pass. Returns (label names, {metric name: results}).
+  """
+  # the metrics required by others but not asked for run without being saved
+  names = set(m.name for m in metrics)
+  required = [METRICS[name]() for name in METRICS
+      if name not in names and any(name in m.requires for m in metrics)]
+  every = sorted(metrics + required, key=lambda m: list(METRICS).index(m.name))
+
+  fields = set(field for m in every for field in m.fields)
+  columns = Columns(*fields)
+  strings = tracefile.StringTable()
+  for chunk in read_chunks(data, strings):
+    columns.append(**{field: getattr(chunk, field) for field in fields})
+    for metric in every:
+      metric.consume(chunk)
+
+  trace = Chunk(*[columns.get(field, dtype) if field in fields else None
+      for field, dtype in zip(Chunk._fields, DTYPES)])
+  del columns # the chunks, now that they've been joined
+  results = {}
+  for metric in every:
+    results[metric.name] = metric.finish(len(strings), trace, results)
+  return strings.strings, {m.name: results[m.name] for m in metrics}
+
+def save_bundle(filename, labels, results):
+  arrays = {"labels": np.array(labels, dtype=np.unicode_)}
+  for metric, fields in results.items():
+    for field, values in fields.items():
+      arrays[metric + "/" + field] = values
+  np.savez_compressed(filename, **arrays)
+
+def load_bundle(filename):
+  """ Returns (label names, {metric name: {field: array}}) from a bundle. """
+  bundle = np.load(filename)
+  labels, results = list(bundle["labels"]), {}
+  for key in bundle.files:
+    if "/" not in key: continue
+    metric, field = key.split("/", 1)
+    results.setdefault(metric, {})[field] = bundle[key]
+  return labels, results
+
+def report(labels, results):
+  """ Prints a per-label summary of whichever metrics were computed. """
+  columns = []
+  if "size_histogram" in results:
+    allocs = results["size_histogram"]["counts"].sum(axis=1)
+    columns.append(("allocs", "%12d", dict(enumerate(allocs))))
+  if "live_counts" in results:
+    r = results["live_counts"]
+    peaks = np.maximum.reduceat(r["values"], r["starts"]) if len(r["starts"]) else []
+    columns.append(("peak live", "%12d", dict(zip(r["labels"], peaks))))
+  if "peak_working_set" in results:
+    r = results["peak_working_set"]
+    columns.append(("peak bytes", "%12d", dict(zip(r["labels"], r["peaks"]))))
+  if "lifetimes" in results:
+    r = results["lifetimes"]
+    medians = r["values"][r["starts"] + r["counts"] // 2]
+    columns.append(("median ms", "%12.4f", dict(zip(r["labels"], medians))))
+  if not columns: return
+
+  if "peak_working_set" in results:
+    r = results["peak_working_set"]
+    print("Peak working set: %d bytes at %f" % (r["peak"], r["peak_time"]))
+  print("%-32s" % "label" + "".join(" %12s" % c[0] for c in columns))
+  for i, label in enumerate(labels):
+    row = "%-32s" % (label or "<unlabeled>")
+    for _, fmt, values in columns:
+      row += " " + (fmt % values[i] if i in values else "%12s" % "-")
+    print(row)
+
+def main(args):
+  options = {AllocRate.name: (args.interval,)}
+  metrics = [METRICS[name](*options.get(name, ()))
+      for name in args.metrics or METRICS]
+  data = tracefile.iter_trace(args.filename)
+  labels, results = analyze(data, metrics)
+  if args.output:
+    save_bundle(args.output, labels, results)
+  report(labels, results)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("filename", nargs="?", metavar="filtered.json",
+      type=argparse.FileType('r'), default=sys.stdin,
+      help="filename for filtered json or msgpack. leave empty to use "
+      "standard input")
+  parser.add_argument("-m", "--metric", dest="metrics", action="append",
+      choices=list(METRICS), help="metric to compute. may be repeated. (all)")
+  parser.add_argument("-o", "--output", type=str, default=None,
+      help="write the results bundle (.npz) to this file")
+  parser.add_argument("--interval", type=float, default=1.0,
+      help="interval length in seconds for alloc_rate (1.0)")
+
+  args = parser.parse_args()
+  sys.exit(main(args))
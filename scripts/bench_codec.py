@@ -0,0 +1,89 @@
+#!/usr/bin/python
+"""
+This script benchmarks encoding and decoding an mtrace json file (raw, merged,
+or filtered) with umsgpack against the json module, to check that msgpack is
+worth converting traces to (see json_to_msgpack.py). Each codec encodes the
+trace's entries in memory and decodes them back, and the best of --repeat
+runs is reported as entries and megabytes per second:
+
+  ./bench_codec.py filtered.json
+  ./bench_codec.py merged.json --limit 100000 --repeat 5
+"""
+
+from __future__ import print_function
+import sys, json, io, argparse, itertools, timeit
+import umsgpack, tracefile
+
+def printerr(*args):
+  print(*args, file=sys.stderr)
+
+def stream_pack(items):
+  fp = io.BytesIO()
+  with umsgpack.ArrayPacker(fp, len(items)) as packer:
+    for item in items:
+      packer.pack(item)
+  return fp.getvalue()
+
+def stream_unpack(data):
+  return list(umsgpack.unpack_array(io.BytesIO(data)))
+
+# (name, (encode, decode)) pairs, benchmarked in this order
+CODECS = [
+  ("json", (json.dumps, json.loads)),
+  ("msgpack", (umsgpack.packb, umsgpack.unpackb)),
+  ("msgpack-stream", (stream_pack, stream_unpack)),
+]
+
+# Returns the fastest of `repeat` runs of function(arg), and its result.
+def best_time(function, arg, repeat):
+  best, result = None, None
+  for _ in range(repeat):
+    start = timeit.default_timer()
+    result = function(arg)
+    elapsed = timeit.default_timer() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best, result
+
+def bench(items, repeat):
+  """ Returns [(codec, encoded size, encode seconds, decode seconds)]. """
+  results = []
+  for name, (encode, decode) in CODECS:
+    encode_time, encoded = best_time(encode, items, repeat)
+    decode_time, decoded = best_time(decode, encoded, repeat)
+    if decoded != items:
+      printerr("Warning:", name, "did not round-trip the trace")
+    results.append((name, len(encoded), encode_time, decode_time))
+  return results
+
+def report(results, count):
+  print("%-16s %10s %14s %10s %14s %10s" % ("codec", "size (MB)",
+      "encode (ev/s)", "(MB/s)", "decode (ev/s)", "(MB/s)"))
+  for name, size, encode_time, decode_time in results:
+    mb = size / float(2**20)
+    print("%-16s %10.2f %14d %10.2f %14d %10.2f" % (name, mb,
+        count / encode_time, mb / encode_time, count / decode_time,
+        mb / decode_time))
+
+def main(args):
+  items = (item for _, _, item in tracefile.iter_json_array(args.filename))
+  items = list(itertools.islice(items, args.limit))
+  if not items:
+    printerr("No entries in the trace")
+    return 1
+
+  printerr("Benchmarking", len(items), "entries")
+  report(bench(items, args.repeat), len(items))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("filename", nargs="?", metavar="trace.json",
+      type=argparse.FileType('r'), default=sys.stdin,
+      help="filename for raw, merged, or filtered json. leave empty to use "
+      "standard input")
+  parser.add_argument("--limit", type=int, default=None,
+      help="only benchmark the first LIMIT entries (all)")
+  parser.add_argument("--repeat", type=int, default=3,
+      help="number of runs per measurement; the fastest is reported (3)")
+
+  args = parser.parse_args()
+  sys.exit(main(args))
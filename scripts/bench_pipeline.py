@@ -0,0 +1,166 @@
+#!/usr/bin/python
+"""
+This script benchmarks the whole pipeline on synthetic traces (see
+gen_trace.py) of increasing size: merge.py, filter.py, json_to_msgpack.py, and
+then each registered model (models/runtrace.py's MODELS) replaying the filtered
+trace. Every step runs in its own process and is reported in raw trace events
+per second along with its peak RSS:
+
+  ./bench_pipeline.py --sizes 100000 1000000 --save-baseline baseline.json
+  ./bench_pipeline.py --sizes 100000 1000000 --baseline baseline.json
+
+With --baseline, steps whose throughput dropped or whose peak RSS grew by more
+than --threshold compared to the stored results are flagged, and the script
+exits with status 1. The generated traces are kept in --workdir and reused by
+later runs with the same size and seed.
+"""
+
+from __future__ import print_function
+import sys, os, json, argparse, subprocess, tempfile, timeit
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+MODELS_DIR = os.path.join(SCRIPTS_DIR, "..", "models")
+
+sys.path.append(MODELS_DIR)
+import runtrace
+
+def printerr(*args):
+  print(*args, file=sys.stderr)
+
+def script(name, directory=SCRIPTS_DIR):
+  return [sys.executable, os.path.join(directory, name)]
+
+def run_step(argv, output=None):
+  """
+  Runs `argv`, writing its standard output to the file `output` (discarded if
+  None). Returns (exit status, seconds, peak RSS in KB) of the process.
+  """
+  with open(output or os.devnull, 'w') as out, open(os.devnull, 'w') as err:
+    start = timeit.default_timer()
+    process = subprocess.Popen(argv, stdout=out, stderr=err)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = timeit.default_timer() - start
+  return status, elapsed, usage.ru_maxrss
+
+def trace_files(workdir, size, seed):
+  """
+  Returns the raw, merged and filtered trace filenames for `size` events,
+  generating the raw trace if it doesn't exist yet.
+  """
+  prefix = os.path.join(workdir, "synthetic-%d-%d" % (size, seed))
+  raw = prefix + ".raw.json"
+  if not os.path.exists(raw):
+    printerr("Generating", size, "events")
+    status, _, _ = run_step(script("gen_trace.py") +
+        ["-n", str(size), "--seed", str(seed), "-o", raw + ".tmp"])
+    if status != 0:
+      raise RuntimeError("gen_trace.py failed")
+    os.rename(raw + ".tmp", raw)
+  return raw, prefix + ".merged.json", prefix + ".filtered.json"
+
+def steps(raw, merged, filtered, models, replay):
+  """ Returns the (name, argv, output file) of each step, in order. """
+  trace = os.path.splitext(filtered)[0] + ".msgpack" if replay == "msgpack" \
+      else filtered
+  result = [
+    ("merge", script("merge.py") + ["false", "false", raw], merged),
+    ("filter", script("filter.py") + ["false", merged], filtered),
+    ("json_to_msgpack", script("json_to_msgpack.py") + [filtered], None),
+  ]
+  for model in models:
+    argv = script("runtrace.py", MODELS_DIR) + ["--no-cache", "-m", model,
+        trace]
+    result.append((model, argv, None))
+  return result
+
+def bench(sizes, models, workdir, seed, replay):
+  results = []
+  for size in sizes:
+    raw, merged, filtered = trace_files(workdir, size, seed)
+    for name, argv, output in steps(raw, merged, filtered, models, replay):
+      printerr("Running", name, "on", size, "events")
+      status, seconds, rss = run_step(argv, output)
+      results.append({"size": size, "step": name, "ok": status == 0,
+          "seconds": seconds, "events_per_sec": size / seconds,
+          "peak_rss_kb": rss})
+      if status != 0:
+        printerr("Warning:", name, "failed on", size, "events")
+  return results
+
+def compare(results, baseline, threshold):
+  """
+  Marks each result that regressed against the `baseline` results. Returns the
+  number of regressions.
+  """
+  previous = {(r["size"], r["step"]): r for r in baseline}
+  regressions = 0
+  for result in results:
+    result["regressions"] = []
+    base = previous.get((result["size"], result["step"]))
+    if base is None: continue
+    if not result["ok"]:
+      if base["ok"]: result["regressions"].append("failed")
+    else:
+      if result["events_per_sec"] < base["events_per_sec"] * (1 - threshold):
+        result["regressions"].append("throughput %+.0f%%" % (100.0 *
+            (result["events_per_sec"] / base["events_per_sec"] - 1)))
+      if result["peak_rss_kb"] > base["peak_rss_kb"] * (1 + threshold):
+        result["regressions"].append("rss %+.0f%%" % (100.0 *
+            (float(result["peak_rss_kb"]) / base["peak_rss_kb"] - 1)))
+    regressions += bool(result["regressions"])
+  return regressions
+
+def report(results):
+  print("%10s %-28s %10s %14s %12s  %s" % ("events", "step", "seconds",
+      "events/sec", "peak RSS MB", "regressions"))
+  for r in results:
+    print("%10d %-28s %10.2f %14d %12.1f  %s" % (r["size"], r["step"],
+        r["seconds"], r["events_per_sec"], r["peak_rss_kb"] / 1024.0,
+        ", ".join(r.get("regressions", [])) or ("-" if r["ok"] else "failed")))
+
+def main(args):
+  if not os.path.isdir(args.workdir):
+    os.makedirs(args.workdir)
+
+  models = args.models or runtrace.MODELS
+  results = bench(args.sizes, models, args.workdir, args.seed, args.replay)
+
+  regressions = 0
+  if args.baseline:
+    with open(args.baseline, 'r') as f:
+      baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.threshold)
+  report(results)
+
+  if args.save_baseline:
+    with open(args.save_baseline, 'w') as f:
+      json.dump({"python": sys.version.split()[0], "seed": args.seed,
+          "results": results}, f, indent=2, sort_keys=True)
+  if regressions:
+    printerr(regressions, "regressions against", args.baseline)
+    return 1
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--sizes", type=int, nargs="+",
+      default=[10**5, 10**6, 10**7],
+      help="trace sizes in events to benchmark (100000 1000000 10000000)")
+  parser.add_argument("-m", "--model", dest="models", action="append",
+      help="import path of a model to replay. may be repeated. "
+      "(runtrace.MODELS)")
+  parser.add_argument("--replay", choices=["json", "msgpack"], default="json",
+      help="which filtered trace format the models replay (json)")
+  parser.add_argument("--seed", type=int, default=0,
+      help="random seed for the synthetic traces (0)")
+  parser.add_argument("--workdir", type=str,
+      default=os.path.join(tempfile.gettempdir(), "autogc-bench"),
+      help="directory for the generated traces (<tmp>/autogc-bench)")
+  parser.add_argument("--baseline", type=str, default=None,
+      help="flag regressions against the results stored in this file")
+  parser.add_argument("--save-baseline", type=str, default=None,
+      help="store the results in this file for later comparisons")
+  parser.add_argument("--threshold", type=float, default=0.1,
+      help="relative slowdown or RSS growth flagged as a regression (0.1)")
+
+  args = parser.parse_args()
+  sys.exit(main(args))
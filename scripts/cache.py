@@ -0,0 +1,108 @@
+"""
+An on-disk cache for the intermediate results of the analysis scripts, so that
+re-running a script on the same trace (to tweak a plot title or a threshold,
+say) skips parsing the trace and goes straight to plotting.
+
+Entries are pickled into one file each under the cache directory, which is
+$AUTOGC_CACHE_DIR or ~/.cache/autogc by default. Entries are keyed by the
+content hash of the input trace and the name and version of the analysis;
+analyses bump their version whenever the shape of what they cache changes.
+Reading an entry marks it as recently used, and the least recently used
+entries are evicted once the cache grows past `max_bytes`.
+"""
+
+import os, hashlib, tempfile
+import cPickle as pickle
+
+DEFAULT_MAX_BYTES = 2 * 2**30
+
+def default_directory():
+  directory = os.environ.get("AUTOGC_CACHE_DIR")
+  if directory: return directory
+  return os.path.join(os.path.expanduser("~"), ".cache", "autogc")
+
+class Cache(object):
+  def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+    self.directory = directory or default_directory()
+    self.max_bytes = max_bytes
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+
+  def key(self, *parts):
+    """ Returns a cache key for the given (repr-able) parts. """
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+  def _path(self, key):
+    return os.path.join(self.directory, key + ".pickle")
+
+  def get(self, key, default=None):
+    path = self._path(key)
+    try:
+      with open(path, 'rb') as f:
+        value = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError, AttributeError,
+        ImportError, ValueError, IndexError):
+      return default # missing, truncated, or pickled by other code
+
+    try:
+      os.utime(path, None) # mark as recently used
+    except OSError:
+      pass # evicted by another process since it was read; the value is fine
+    return value
+
+  def put(self, key, value):
+    # write to a temporary file first so that readers never see a partial entry
+    fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+    with os.fdopen(fd, 'wb') as f:
+      pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, self._path(key))
+    self.evict()
+
+  def memoize(self, key, compute):
+    """ Returns the value for `key`, calling and caching compute() on a miss. """
+    missing = object()
+    value = self.get(key, missing)
+    if value is missing:
+      value = compute()
+      self.put(key, value)
+    return value
+
+  def evict(self):
+    """ Removes the least recently used entries until the cache fits. """
+    entries, total = [], 0
+    for name in os.listdir(self.directory):
+      if not name.endswith(".pickle"): continue
+      path = os.path.join(self.directory, name)
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, path))
+      total += stat.st_size
+
+    entries.sort()
+    for _, size, path in entries:
+      if total <= self.max_bytes: break
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      total -= size
+
+  def content_hash(self, filename, chunk_size=1 << 20):
+    """
+    Returns the SHA-1 of the contents of `filename`. The hash itself is cached
+    by path, size and modification time so unchanged traces aren't re-read.
+    """
+    stat = os.stat(filename)
+    key = self.key("content_hash", os.path.abspath(filename), stat.st_size,
+        stat.st_mtime)
+
+    def compute():
+      sha1 = hashlib.sha1()
+      with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ""):
+          sha1.update(chunk)
+      return sha1.hexdigest()
+
+    return self.memoize(key, compute)
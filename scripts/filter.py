@@ -17,13 +17,19 @@ an object of type 'thing', the deallocation is filtered out of the data set. In
 essence, this script provides a filtered memory trace containing only the
 essential data to model garbage collectors on.
 
+The merged trace is streamed in and each entry is kept only as a compact
+(timestamp, type, bytes, name id, addr) tuple, with label names interned into
+a StringTable and addresses parsed into ints, until the entries are sorted and
+written out.
+
 TODO: Get some kind of stack size/position data for allocators that need to
 scan the stack.
 """
 
 from __future__ import print_function
 import sys, json, os, argparse
-import itertools
+import itertools, operator
+import tracefile
 
 # global constants
 BAD_FREE_TYPE = -1
@@ -33,25 +39,26 @@ ALLOC_TYPE = 1
 def printerr(*args):
   print(*args, file=sys.stderr)
 
-def extract_alloc(base, label):
-  alloc = base.copy()
-  alloc['type'] = ALLOC_TYPE
-  alloc['timestamp'] = label['timestamp_alloc']
-  return alloc
+# fields of a filtered entry record
+TIMESTAMP, TYPE, BYTES, NAME, ADDR = range(5)
+
+def extract_alloc(name, size, addr, label):
+  return (label['timestamp_alloc'], ALLOC_TYPE, size, name, addr)
 
-def extract_free_from_merged(base, label):
-  free = base.copy()
-  free['type'] = FREE_TYPE
-  free['timestamp'] = label['timestamp_free']
-  return free
+def extract_free_from_merged(name, size, addr, label):
+  return (label['timestamp_free'], FREE_TYPE, size, name, addr)
 
-def filter_label(label):
+def filter_label(label, strings):
+  """
+  Yields the filtered entry records for the merged `label` as tuples of
+  (timestamp, type, bytes, name id, int addr).
+  """
   # Figure out if we're dealing with a matched alloc/free pair
-  size, name, addr = label['bytes'], label['label'], label['host_addr']
-  base = {"name": name, "bytes": size, "addr": addr}
+  size, addr = label['bytes'], tracefile.parse_addr(label['host_addr'])
+  name = strings.intern(label['label'])
   if 'timestamp_free' in label and 'timestamp_alloc' in label:
-    yield extract_alloc(base, label)
-    yield extract_free_from_merged(base, label)
+    yield extract_alloc(name, size, addr, label)
+    yield extract_free_from_merged(name, size, addr, label)
     return
 
   # Must be a rouge alloc/free. Make sure.
@@ -61,26 +68,34 @@ def filter_label(label):
 
   # Do we have a rouge free?
   if 'timestamp_free' in label:
-    filtered = base.copy()
-    filtered['name'] = "inv"
-    filtered['type'] = BAD_FREE_TYPE
-    filtered['timestamp'] = label['timestamp_free']
-    yield filtered
+    yield (label['timestamp_free'], BAD_FREE_TYPE, size, strings.intern("inv"),
+        addr)
     return
 
   # Must be a rouge alloc
-  yield extract_alloc(base, label)
+  yield extract_alloc(name, size, addr, label)
   return
 
+def to_dict(record, strings):
+  return {
+    "timestamp": record[TIMESTAMP],
+    "type": record[TYPE],
+    "bytes": record[BYTES],
+    "name": strings[record[NAME]],
+    "addr": tracefile.format_addr(record[ADDR]),
+  }
+
 def main(data, discard_invalid):
+  strings = tracefile.StringTable()
   labels = itertools.ifilter(lambda entry: entry["type"] == "label", data)
-  filtered = [x for l in labels for x in filter_label(l)]
-
-  if discard_invalid: # discard invalid entries if requested
-    filtered = itertools.ifilter(lambda l: l["type"] != BAD_FREE_TYPE, filtered)
+  filtered = [x for l in labels for x in filter_label(l, strings)
+      if not (discard_invalid and x[TYPE] == BAD_FREE_TYPE)]
 
-  sorted_filtered = sorted(filtered, key = lambda l: float(l['timestamp']))
-  print(json.dumps(sorted_filtered))
+  # list.sort is stable, so an alloc and free with equal timestamps keep their
+  # order
+  filtered.sort(key=operator.itemgetter(TIMESTAMP))
+  tracefile.write_json_array(sys.stdout,
+      (to_dict(record, strings) for record in filtered))
 
 if __name__ == "__main__":
   def boolean(string):
@@ -98,5 +113,5 @@ if __name__ == "__main__":
       help="filename for merged json. leave empty to use standard input")
 
   args = parser.parse_args()
-  data = json.load(args.filename)
+  data = (item for _, _, item in tracefile.iter_json_array(args.filename))
   sys.exit(main(data, args.discard_invalid))
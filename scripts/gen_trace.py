@@ -0,0 +1,167 @@
+#!/usr/bin/python
+"""
+This script generates a synthetic raw mtrace json file (the input of merge.py)
+so that the pipeline and the models can be benchmarked reproducibly without
+sharing real traces (see bench_pipeline.py).
+
+Allocations arrive at exponentially distributed intervals (--rate per second).
+Each picks a label by weight, a size from the label's sizes, and a lifetime from
+the label's lifetime distribution, and is freed once its lifetime is up. The
+label mix is described by a profile, DEFAULT_PROFILE unless --profile names a
+json file of the same shape:
+
+  {"labels": {"kmalloc-64": {"weight": 4, "sizes": [64],
+                             "lifetime": ["lognormal", -2.0, 1.5]}, ...}}
+
+where a lifetime (in seconds) is ["exponential", mean], ["lognormal", mu,
+sigma] (of the log of the lifetime) or ["pareto", alpha, scale].
+
+Freed addresses are reused (most recently freed first) with probability
+--reuse, like a real allocator would. A fraction of allocations are never freed
+(--rogue-allocs) and a fraction of frees are of addresses that were never
+allocated (--rogue-frees), which merge.py reports and handles. The same seed
+and options always produce the same trace:
+
+  ./gen_trace.py -n 1000000 -o raw.json
+  ./gen_trace.py -n 100000 --profile profile.json --seed 7 | ./merge.py
+"""
+
+from __future__ import print_function
+import sys, json, argparse, random, heapq
+import tracefile
+
+ALLOC_PC = "0xffffffff81127d43"
+FREE_PC = "0xffffffff811279be"
+GUEST_ADDR = "0xffff880007bcce00"
+BASE_ADDR = 0x7fbc29000000
+ROGUE_BASE_ADDR = 0x7fff00000000
+START_TIME = 1401904885.0
+
+DEFAULT_PROFILE = {
+  "labels": {
+    "kmalloc-64": {"weight": 8, "sizes": [64], "lifetime": ["lognormal", -3.0, 2.0]},
+    "kmalloc-128": {"weight": 4, "sizes": [128], "lifetime": ["lognormal", -3.0, 2.0]},
+    "kmalloc-256": {"weight": 4, "sizes": [256], "lifetime": ["lognormal", -2.5, 2.0]},
+    "kmalloc-512": {"weight": 2, "sizes": [512], "lifetime": ["lognormal", -2.0, 2.0]},
+    "kmalloc-1024": {"weight": 1, "sizes": [1024], "lifetime": ["lognormal", -2.0, 2.0]},
+    "dentry": {"weight": 6, "sizes": [192], "lifetime": ["pareto", 1.2, 0.05]},
+    "inode_cache": {"weight": 3, "sizes": [592], "lifetime": ["pareto", 1.2, 0.1]},
+    "buffer_head": {"weight": 5, "sizes": [104], "lifetime": ["exponential", 0.5]},
+    "vm_area_struct": {"weight": 6, "sizes": [184], "lifetime": ["exponential", 0.05]},
+    "filp": {"weight": 3, "sizes": [256], "lifetime": ["exponential", 0.2]},
+    "anon_vma": {"weight": 2, "sizes": [72], "lifetime": ["exponential", 0.1]},
+    "skbuff_head_cache": {"weight": 4, "sizes": [256], "lifetime": ["exponential", 0.002]},
+  }
+}
+
+def printerr(*args):
+  print(*args, file=sys.stderr)
+
+def lifetime_sampler(rng, spec):
+  """ Returns a function drawing lifetimes (s) from the distribution `spec`. """
+  kind, params = spec[0], spec[1:]
+  if kind == "exponential":
+    return lambda: rng.expovariate(1.0 / params[0])
+  elif kind == "lognormal":
+    return lambda: rng.lognormvariate(params[0], params[1])
+  elif kind == "pareto":
+    return lambda: params[1] * rng.paretovariate(params[0])
+  raise ValueError("unknown lifetime distribution: " + kind)
+
+class Label(object):
+  def __init__(self, rng, name, spec):
+    self.name = name
+    self.sizes = spec["sizes"]
+    self.lifetime = lifetime_sampler(rng, spec["lifetime"])
+
+def label_event(ts, label, addr, size, pc):
+  return {"timestamp": round(ts, 6), "cpu": 0, "access_count": 0,
+      "type": "label", "label_type": 1, "label": label, "pc": pc,
+      "host_addr": tracefile.format_addr(addr), "guest_addr": GUEST_ADDR,
+      "bytes": size}
+
+def generate(events, profile, seed=0, rate=10000.0, reuse=0.9,
+    rogue_allocs=0.001, rogue_frees=0.001):
+  """ Yields `events` raw mtrace label events, in time order. """
+  rng = random.Random(seed)
+  names = sorted(profile["labels"])
+  labels = [Label(rng, name, profile["labels"][name]) for name in names]
+  cumulative, total = [], 0.0
+  for name in names:
+    total += profile["labels"][name]["weight"]
+    cumulative.append(total)
+
+  def pick_label():
+    x = rng.random() * total
+    for label, bound in zip(labels, cumulative):
+      if x < bound: return label
+    return labels[-1]
+
+  ts, next_addr, next_rogue = START_TIME, BASE_ADDR, ROGUE_BASE_ADDR
+  pending = [] # heap of (free time, sequence number, addr)
+  freed = {} # size -> stack of freed addrs, for reuse
+  count, seq = 0, 0
+  while count < events:
+    ts += rng.expovariate(rate)
+
+    # free everything whose lifetime is up
+    while pending and pending[0][0] <= ts and count < events:
+      free_ts, _, addr, size = heapq.heappop(pending)
+      yield label_event(free_ts, "", addr, 0, FREE_PC)
+      freed.setdefault(size, []).append(addr)
+      count += 1
+
+    if count < events and rng.random() < rogue_frees:
+      yield label_event(ts, "", next_rogue, 0, FREE_PC)
+      next_rogue += 64
+      count += 1
+    if count >= events: break
+
+    label = pick_label()
+    size = rng.choice(label.sizes)
+    stack = freed.get(size)
+    if stack and rng.random() < reuse:
+      addr = stack.pop()
+    else:
+      addr = next_addr
+      next_addr += (size + 63) // 64 * 64
+    yield label_event(ts, label.name, addr, size, ALLOC_PC)
+    count += 1
+
+    if rng.random() >= rogue_allocs:
+      heapq.heappush(pending, (ts + label.lifetime(), seq, addr, size))
+      seq += 1
+
+def main(args):
+  profile = DEFAULT_PROFILE
+  if args.profile:
+    with open(args.profile, 'r') as f:
+      profile = json.load(f)
+
+  items = generate(args.events, profile, args.seed, args.rate, args.reuse,
+      args.rogue_allocs, args.rogue_frees)
+  out = open(args.output, 'w') if args.output else sys.stdout
+  tracefile.write_json_array(out, items)
+  if args.output: out.close()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("-n", "--events", type=int, default=100000,
+      help="number of label events to generate (100000)")
+  parser.add_argument("-o", "--output", type=str, default=None,
+      help="write the trace to this file instead of standard output")
+  parser.add_argument("--profile", type=str, default=None,
+      help="json file describing the label mix (built-in kernel-like mix)")
+  parser.add_argument("--seed", type=int, default=0,
+      help="random seed (0)")
+  parser.add_argument("--rate", type=float, default=10000.0,
+      help="mean number of allocations per second (10000)")
+  parser.add_argument("--reuse", type=float, default=0.9,
+      help="probability that an allocation reuses a freed address (0.9)")
+  parser.add_argument("--rogue-allocs", type=float, default=0.001,
+      help="fraction of allocations that are never freed (0.001)")
+  parser.add_argument("--rogue-frees", type=float, default=0.001,
+      help="fraction of frees of addresses never allocated (0.001)")
+
+  args = parser.parse_args()
+  sys.exit(main(args))
@@ -1,30 +1,53 @@
 #! /usr/bin/python
 from __future__ import print_function
-import umsgpack, os, sys, json
+import umsgpack, tracefile, os, sys, argparse, itertools
 
 def printerr(*args):
   print(*args, file=sys.stderr)
 
-# Converts a json file into a msgpack file.
-if __name__ == "__main__":
-  def die(message):
-    printerr("Error:", message)
-    printerr("usage:", sys.argv[0], "input-file")
-    printerr("example:", sys.argv[0], "file.json")
-    exit(1)
+# Converts a json trace into a msgpack file, one array element at a time so that
+# neither the json nor the msgpack version of the trace is ever held in memory.
+# Filtered traces are written in the compact encoding (see tracefile.py) unless
+# `maps` is set; other traces are written as one map per entry. The analysis
+# scripts and gcmodel.TraceRunner read either encoding.
+def convert(f, out, maps=False):
+  items = (item for _, _, item in tracefile.iter_json_array(f))
+  first = next(items, None)
+  items = itertools.chain([first] if first is not None else [], items)
+
+  if not maps and tracefile.is_compact_entry(first):
+    writer = tracefile.CompactWriter(out)
+    write = writer.write
+  else:
+    writer = umsgpack.ArrayPacker(out)
+    write = writer.pack
 
-  if len(sys.argv) != 2:
-    die("Incorrect number of arguments.")
+  for item in items:
+    write(item)
+  writer.close()
+  return writer.count
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("filename", metavar="file.json", type=str,
+      help="filename for raw, merged, or filtered json. required. the output "
+      "is written next to it as file.msgpack")
+  parser.add_argument("--maps", action="store_true",
+      help="write filtered traces as one map per entry instead of compactly")
+  args = parser.parse_args()
 
   try:
-    filename = sys.argv[1]
-    data = json.load(open(filename, "r"))
-  except:
-    die("Invalid file path or JSON.")
+    f = open(args.filename, "r")
+  except IOError:
+    parser.error("invalid file path")
 
   try:
-    msgpack_data = umsgpack.packb(data)
-    with open(os.path.splitext(filename)[0] + ".msgpack", 'w') as f:
-      f.write(msgpack_data)
-  except:
-    die("Error writing out msgpack file.")
+    with open(os.path.splitext(args.filename)[0] + ".msgpack", 'wb') as out:
+      count = convert(f, out, args.maps)
+  except ValueError as e:
+    printerr("Error: invalid trace:", e)
+    sys.exit(1)
+  except (IOError, umsgpack.PackException) as e:
+    printerr("Error writing out msgpack file:", e)
+    sys.exit(1)
+  printerr("Converted", count, "entries")
@@ -2,68 +2,108 @@
 
 from __future__ import print_function
 
-# Force matplotlib to not use any Xwindows backend.
-import matplotlib
-matplotlib.use('Agg')
-
 import sys, json, os, argparse
-import itertools
+import itertools, array
+import multiprocessing as mp
 import numpy
-import matplotlib.pyplot as plt
+import tracefile, cache, plotting
 
 """
 The goal of this script is to take merged mtrace label entries with
 timestamp_alloc and timestamp_free properties, calculate the lifetime of an
 allocation (free - alloc), group the lifetimes by label name, and generate a
 histrogram with a CDF overlayed on top for each of the label named.
+
+The lifetimes are extracted into NumPy arrays in a single pass over the trace
+and grouped by label with one sort, after which the statistics for all labels
+(percentiles, outlier cutoffs, bin counts) are computed with array operations.
+The grouped lifetimes are cached on disk by the trace's content hash (see
+cache.py), so re-running the script on the same trace only re-plots.
+With --summary, the script only writes the per-label statistics to a JSON or
+CSV file and never imports matplotlib, which keeps batch runs over many traces
+fast.
+For traces too large to hold every lifetime in memory, sketch.py computes the
+lifetime quantiles in fixed memory instead.
 """
 
 def printerr(*args):
   print(*args, file=sys.stderr)
 
-# Returns a dict where the key is a label name and the value is an array of
-# lifetime values. There is one entry for each object type.
+# Extracts the label ids and lifetimes of the merged entries in one pass and
+# groups them with a single sort. Returns (labels, lifetimes, starts, counts):
+# `lifetimes` is sorted by label and then by value, and the lifetimes of
+# labels[i] are lifetimes[starts[i]:starts[i] + counts[i]].
 def group_lifetimes_by_label(data):
-  output = {}
+  strings = tracefile.StringTable()
+  ids, allocs, frees = array.array('i'), array.array('d'), array.array('d')
   for item in data:
     # skip extra allocs/frees
     if 'extra' in item: continue
 
-    label = item['label']
-    if label not in output:
-      output[label] = []
-    output[label].append(get_lifetime(item))
-  return output
-
-def get_lifetime(label):
-  return (label['timestamp_free'] - label['timestamp_alloc']) * 10**3
-
-def IQR(values):
-  return numpy.percentile(values, 75) - numpy.percentile(values, 25)
-
-def freedman_diaconis_rule(values):
-  return 2 * IQR(values) * (len(values)**(-1/3))
-
-# Removes extreme outliers to get reasonable graphs
-def remove_outliers(groups):
-  def get_values_for_key(k):
-    p = .95 # bottom percentile to keep
-    sorted_values = numpy.sort(numpy.array(groups[k]))
-    count = len(sorted_values)
-    top_index = count if count < int(1 / (1 - p)) else count * p
-    return sorted_values[:top_index]
-  return get_values_for_key
-
-# mv = mapped_values
-# Removes all entries in mv with <= num elements in its value
-def filter_low(mv, num):
-  for key in mv:
-    count = len(mv[key])
-    if count <= num: printerr("Filtering out", key, "(" + str(count) + ")")
-  return {key: mv[key] for key in mv if len(mv[key]) > num}
+    ids.append(strings.intern(item['label']))
+    allocs.append(item['timestamp_alloc'])
+    frees.append(item['timestamp_free'])
+
+  ids = numpy.frombuffer(ids, dtype=numpy.intc)
+  allocs = numpy.frombuffer(allocs, dtype=numpy.float64)
+  frees = numpy.frombuffer(frees, dtype=numpy.float64)
+  lifetimes = get_lifetime(allocs, frees)
+
+  order = numpy.lexsort((lifetimes, ids))
+  ids, lifetimes = ids[order], lifetimes[order]
+  label_ids, starts, counts = numpy.unique(ids, return_index=True,
+      return_counts=True)
+  labels = numpy.array([strings[i] for i in label_ids], dtype=object)
+  return labels, lifetimes, starts, counts
+
+def get_lifetime(allocs, frees):
+  return (frees - allocs) * 10**3
+
+# Returns the q-th percentiles of each group, interpolating linearly like
+# numpy.percentile. The groups must be sorted.
+def percentiles(lifetimes, starts, counts, q):
+  position = starts + (counts - 1) * (q / 100.0)
+  below = numpy.floor(position).astype(int)
+  above = numpy.minimum(below + 1, starts + counts - 1)
+  fraction = position - below
+  return lifetimes[below] * (1 - fraction) + lifetimes[above] * fraction
+
+def IQR(lifetimes, starts, counts):
+  return (percentiles(lifetimes, starts, counts, 75) -
+      percentiles(lifetimes, starts, counts, 25))
+
+def freedman_diaconis_rule(lifetimes, starts, counts):
+  iqr = IQR(lifetimes, starts, counts)
+  return 2 * iqr * (counts.astype(float)**(-1/3))
+
+# Returns the number of histogram bins for each group
+def histogram_bins(lifetimes, starts, counts):
+  # Calculating number of bins using Freedman-Diaconis Rule
+  bin_width = freedman_diaconis_rule(lifetimes, starts, counts)
+  amax, amin = lifetimes[starts + counts - 1], lifetimes[starts]
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    num_bins = ((amax - amin) / bin_width) / 3
+  num_bins = numpy.clip(numpy.nan_to_num(num_bins), 1, 120)
+  return num_bins.astype(int)
+
+# Removes extreme outliers to get reasonable graphs. Since each group is
+# sorted, this only shortens the groups; returns the new counts.
+def remove_outliers(counts):
+  p = .95 # bottom percentile to keep
+  top_index = (counts * p).astype(int)
+  return numpy.where(counts < int(1 / (1 - p)), counts, top_index)
+
+# Removes all groups with <= num elements. Returns the remaining
+# (labels, starts, counts).
+def filter_low(labels, starts, counts, num):
+  low = counts <= num
+  for label, count in zip(labels[low], counts[low]):
+    printerr("Filtering out", label, "(" + str(count) + ")")
+  return labels[~low], starts[~low], counts[~low]
 
 def generate_boxplot(mapped_values, filename):
   print("Generating boxplot")
+  plt = plotting.pyplot()
 
   # Creating the figure object, setting titles and labels
   fig, ax1 = plt.subplots(figsize=(10,5))
@@ -97,15 +137,11 @@ def generate_boxplot(mapped_values, filename):
   plt.setp(bp['fliers'], color='red', marker='+')
   plt.setp(bp['medians'], color='blue')
   plt.savefig(filename)
+  plt.close(fig)
 
-def generate_histogram(name, values, filename):
+def generate_histogram(name, values, num_bins, filename):
   print("Working on", name)
-
-  # Calculating number of bins using Freedman-Diaconis Rule
-  bin_width = freedman_diaconis_rule(values)
-  amax, amin = numpy.amax(values), numpy.amin(values)
-  num_bins = ((amax - amin) / float(bin_width)) / 3
-  num_bins = max(min(num_bins, 120), 1)
+  plt = plotting.pyplot()
 
   fig, ax1 = plt.subplots()
   ax1.set_title("Lifetime Distribution for " + name + " Objects")
@@ -125,24 +161,60 @@ def generate_histogram(name, values, filename):
   ax2.yaxis.grid(True, linestyle='--', which='major', color='b', alpha=0.35)
 
   # Generating a CDF to plot on top of histogram
-  cdf = numpy.cumsum(counts)
-  max_count, count_sum = max(counts), sum(counts)
-  cdf_points = map(lambda c: float(c) / sum(counts), cdf)
-  ax2.plot(bin_edges, [0] + cdf_points)
+  cdf = numpy.cumsum(counts) / float(counts.sum())
+  ax2.plot(bin_edges, numpy.concatenate(([0], cdf)))
 
   plt.savefig(filename)
-
-def main(data):
-  groups = group_lifetimes_by_label(data)
-  mapped_values = {key: remove_outliers(groups)(key) for key in groups}
-  mapped_values = filter_low(mapped_values, 15) # removes objs with <= 15 vals
-
-  # A boxplot comparing all lifetimes
-  generate_boxplot(mapped_values, "boxplot.pdf")
-
-  # A histogram for each object type
-  for key in mapped_values:
-    generate_histogram(key, mapped_values[key], key + "_histo.pdf")
+  plt.close(fig)
+
+# bump whenever the output of group_lifetimes_by_label changes
+ANALYSIS_VERSION = 1
+
+# Returns the grouped lifetimes of the merged trace in the file `f`. Results are
+# cached by the trace's content hash, so later runs on the same trace skip
+# parsing it.
+def load_groups(f, use_cache=True):
+  def compute():
+    return group_lifetimes_by_label(tracefile.iter_trace(f))
+
+  if not use_cache or not os.path.isfile(f.name):
+    return compute()
+  analysis_cache = cache.Cache()
+  key = analysis_cache.key("label_histo", ANALYSIS_VERSION,
+      analysis_cache.content_hash(f.name))
+  return analysis_cache.memoize(key, compute)
+
+SUMMARY_FIELDS = ["label", "count", "mean", "min", "p25", "median", "p75",
+    "p95", "p99", "max"]
+
+# Returns a row of lifetime statistics (ms) for each label, over all of its
+# lifetimes (before outliers are removed).
+def summarize(groups):
+  labels, lifetimes, starts, counts = groups
+  if not len(labels): return []
+  sums = numpy.add.reduceat(lifetimes, starts)
+  stats = [labels, counts, sums / counts, lifetimes[starts]]
+  stats += [percentiles(lifetimes, starts, counts, q)
+      for q in (25, 50, 75, 95, 99)]
+  stats.append(lifetimes[starts + counts - 1])
+  return [dict(zip(SUMMARY_FIELDS, row)) for row in zip(*stats)]
+
+def main(groups, jobs=1):
+  labels, lifetimes, starts, counts = groups
+  counts = remove_outliers(counts)
+  # removes objs with <= 15 vals
+  labels, starts, counts = filter_low(labels, starts, counts, 15)
+  num_bins = histogram_bins(lifetimes, starts, counts)
+  mapped_values = {label: lifetimes[start:start + count]
+      for label, start, count in zip(labels, starts, counts)}
+
+  # A boxplot comparing all lifetimes, rendered alongside a histogram for each
+  # object type
+  figures = [(generate_boxplot, (mapped_values, "boxplot.pdf"))]
+  for label, bins in zip(labels, num_bins):
+    args = (label, mapped_values[label], bins, label + "_histo.pdf")
+    figures.append((generate_histogram, args))
+  plotting.render_all(figures, jobs)
 
   # print(json.dumps(groups))
 
@@ -150,8 +222,18 @@ if __name__ == "__main__":
   parser = argparse.ArgumentParser()
   parser.add_argument("filename", nargs="?", metavar="merged.json",
       type=argparse.FileType('r'), default=sys.stdin,
-      help="filename for merged json. leave empty to use standard input")
+      help="filename for merged json or msgpack. leave empty to use "
+      "standard input")
+  parser.add_argument("-j", "--jobs", type=int, default=mp.cpu_count(),
+      help="number of processes to render figures with (cpu count)")
+  parser.add_argument("--no-cache", dest="use_cache", action="store_false",
+      help="don't read or write the analysis cache ($AUTOGC_CACHE_DIR)")
+  parser.add_argument("--summary", type=str, default=None, metavar="FILE",
+      help="only write per-label statistics to FILE (.csv or .json, - for "
+      "stdout) instead of plotting")
 
   args = parser.parse_args()
-  data = json.load(args.filename)
-  sys.exit(main(data))
+  groups = load_groups(args.filename, args.use_cache)
+  if args.summary:
+    sys.exit(plotting.write_summary(summarize(groups), SUMMARY_FIELDS, args.summary))
+  sys.exit(main(groups, args.jobs))
@@ -2,7 +2,8 @@
 
 from __future__ import print_function
 import sys, json, os, argparse
-import itertools
+import itertools, collections
+import tracefile
 
 """
 The goal of this script is to combine the allocation and free calls of an
@@ -59,76 +60,235 @@ not have a corresponding alloc, it will be discarded if discardFreeFlag=true,
 otherwise it will be appended to the end of the stream. If either of these
 are appended to the end of the trace, they will be appended with the key
 'extra' set to true.
+
+If an address is allocated again before it is freed, the earlier allocations
+are recorded in the 'others' key of the newest one as a run-length history:
+
+  "others": {
+    "count": 5,
+    "dropped": 0,
+    "runs": [["kmalloc-256", 256, 4, 1401904885.633304, 1401904885.701312],
+             ["dentry", 192, 1, 1401904885.790211, 1401904885.790211]]
+  }
+
+Each run is [label, bytes, count, first timestamp_alloc, last timestamp_alloc]
+for consecutive re-allocations with the same label and size. 'count' is the
+total number of re-allocations. At most MAX_HISTORY_RUNS runs are kept; the
+allocations in older runs are only counted in 'dropped'.
+
+The trace is streamed in and each merged entry is written out as soon as its
+free is seen, so only the outstanding allocations are held in memory. These are
+kept as compact Label records: label names are interned into integer ids and
+addresses are parsed into ints, then converted back on output. Only the fields
+shown above are kept.
+
+Re-allocations of an address that was never freed and frees without a matching
+allocation are not reported as they happen. Instead, they are tallied in a
+Diagnostics object and summarized on stderr once the merge is done. Pass
+--verbose to additionally print each occurrence as it is seen.
 """
 
+# maximum number of runs kept in an address' re-allocation history
+MAX_HISTORY_RUNS = 16
+
 def printerr(*args):
   print(*args, file=sys.stderr)
 
-def main(data, discardAllocsFlag, discardFreesFlag):
+def parse_addr(addr):
+  return None if addr is None else tracefile.parse_addr(addr)
+
+def format_addr(addr):
+  return None if addr is None else tracefile.format_addr(addr)
+
+class Label(object):
+  """
+  A compact 'label' entry. The label name is interned into an id of a
+  StringTable and the addresses are kept as ints. Fields that are missing from
+  the entry are None and are left out when it is converted back to a dict.
+  """
+  __slots__ = ('label', 'host_addr', 'guest_addr', 'pc', 'cpu', 'access_count',
+      'label_type', 'bytes', 'timestamp_alloc', 'timestamp_free', 'others',
+      'extra')
+
+  def __init__(self, entry, strings):
+    get = entry.get
+    self.label = strings.intern(entry['label'])
+    self.host_addr = parse_addr(entry['host_addr'])
+    self.guest_addr = parse_addr(get('guest_addr'))
+    self.pc = parse_addr(get('pc'))
+    self.cpu = get('cpu')
+    self.access_count = get('access_count')
+    self.label_type = get('label_type')
+    self.bytes = entry['bytes']
+    self.timestamp_alloc = self.timestamp_free = None
+    if self.bytes > 0:
+      self.timestamp_alloc = entry['timestamp']
+    else:
+      self.timestamp_free = entry['timestamp']
+    self.others = None
+    self.extra = None
+
+  def to_dict(self, strings):
+    entry = {
+      "type": "label",
+      "label": strings[self.label],
+      "host_addr": format_addr(self.host_addr),
+      "guest_addr": format_addr(self.guest_addr),
+      "pc": format_addr(self.pc),
+      "cpu": self.cpu,
+      "access_count": self.access_count,
+      "label_type": self.label_type,
+      "bytes": self.bytes,
+      "timestamp_alloc": self.timestamp_alloc,
+      "timestamp_free": self.timestamp_free,
+      "extra": self.extra,
+    }
+    if self.others is not None:
+      runs = [[strings[run[0]]] + run[1:] for run in self.others['runs']]
+      entry['others'] = dict(self.others, runs=runs)
+    return {k: v for k, v in entry.items() if v is not None}
+
+class Diagnostics(object):
+  """
+  Counts the anomalies seen while merging: re-allocations (an address that is
+  allocated again before being freed) and rogue frees (a free with no
+  allocation). Counts are kept per label and per address; only the `top`
+  most offending addresses are reported. At most `max_addrs` addresses are
+  counted at once: past that, only the most offending half are kept, and the
+  address counts become lower bounds. In verbose mode, every occurrence is
+  also printed as it is recorded.
+  """
+  def __init__(self, top=10, verbose=False, max_addrs=10000):
+    self.top = top
+    self.verbose = verbose
+    self.max_addrs = max(max_addrs, 2 * top)
+    self.reallocs = collections.Counter() # label -> number of re-allocs
+    self.rogue_frees = collections.Counter() # label -> number of rogue frees
+    self.addrs = collections.Counter() # host_addr -> number of anomalies
+    self.pruned = False # whether addresses were dropped from self.addrs
+
+  def count_addr(self, host_addr):
+    self.addrs[host_addr] += 1
+    if len(self.addrs) > self.max_addrs:
+      self.addrs = collections.Counter(dict(
+          self.addrs.most_common(self.max_addrs // 2)))
+      self.pruned = True
+
+  def realloc(self, savedLabel, strings):
+    self.reallocs[strings[savedLabel.label]] += 1
+    self.count_addr(savedLabel.host_addr)
+    if self.verbose:
+      printerr("I've seen", format_addr(savedLabel.host_addr), "before")
+      printerr(savedLabel.to_dict(strings), "\n")
+
+  def rogue_free(self, label, strings):
+    self.rogue_frees[strings[label.label]] += 1
+    self.count_addr(label.host_addr)
+    if self.verbose:
+      printerr("No Alloc for Host Address:", format_addr(label.host_addr))
+
+  def report(self):
+    """ Prints a summary of the recorded anomalies to stderr. """
+    def print_counts(title, counter):
+      printerr(title + ":", sum(counter.values()))
+      for label, count in counter.most_common():
+        printerr("  %-32s %d" % (label or "<unlabeled>", count))
+
+    print_counts("Re-allocations", self.reallocs)
+    print_counts("Rogue frees", self.rogue_frees)
+    if self.addrs:
+      printerr("Top", min(self.top, len(self.addrs)), "offending addresses" +
+          (" (at least; less offending ones were dropped):" if self.pruned
+          else ":"))
+      for host_addr, count in self.addrs.most_common(self.top):
+        printerr("  %-32s %d" % (format_addr(host_addr), count))
+
+def main(data, discardAllocsFlag, discardFreesFlag, diagnostics=None):
+  if diagnostics is None: diagnostics = Diagnostics()
+  strings = tracefile.StringTable()
   labels = itertools.ifilter(lambda entry: entry["type"] == "label", data)
-  results = handle_labels(labels, discardAllocsFlag, discardFreesFlag)
-  print(json.dumps(results))
+  results = handle_labels(labels, discardAllocsFlag, discardFreesFlag,
+      diagnostics, strings)
+  tracefile.write_json_array(sys.stdout,
+      (label.to_dict(strings) for label in results))
+  diagnostics.report()
 
-def handle_labels(labels, discardExtraAllocs, discardExtraFrees):
-  output = [] # Merged alloc/frees
+def handle_labels(labels, discardExtraAllocs, discardExtraFrees, diagnostics,
+    strings):
+  """
+  Yields the merged Label records as soon as their free is seen, followed by
+  the rogue/extra allocs and frees unless they're discarded.
+  """
   allocs = {} # Allocations keyed by host_addr
   extraFrees = [] # Frees that did not have an allocation
-  for label in labels:
-    if label['bytes'] > 0:
-      handle_alloc(allocs, label)
+  for entry in labels:
+    label = Label(entry, strings)
+    if label.bytes > 0:
+      handle_alloc(allocs, label, diagnostics, strings)
     else:
-      handle_free(allocs, output, label, extraFrees)
+      merged = handle_free(allocs, label, extraFrees, diagnostics, strings)
+      if merged is not None: yield merged
 
   if not discardExtraAllocs:
-    for v in allocs.values(): v['extra'] = True
-    output += allocs.values()
+    for v in allocs.itervalues():
+      v.extra = True
+      yield v
 
   if not discardExtraFrees:
-    for v in extraFrees: v['extra'] = True
-    output += extraFrees
+    for v in extraFrees:
+      v.extra = True
+      yield v
 
-  return output
+def handle_alloc(allocs, label, diagnostics, strings):
+  host_addr = label.host_addr
 
-def handle_alloc(allocs, label):
-  host_addr = label['host_addr']
-
-  # Check if allocation previously seen. If so, save it in 'others' array.
+  # Check if allocation previously seen. If so, record it in 'others'.
   if host_addr in allocs:
     savedLabel = allocs[host_addr]
-    label['others'] = savedLabel
-    if "others" in savedLabel:
-      label['others'] += savedLabel['others']
-      del savedLabel['others']
-
-    # Debug output
-    printerr("I've seen", host_addr, "before")
-    printerr(savedLabel, "\n")
-
-  # Replace 'timestamp' key with 'timestamp_alloc'
-  label['timestamp_alloc'] = label['timestamp']
-  del label['timestamp']
+    label.others = record_realloc(savedLabel.others, savedLabel)
+    savedLabel.others = None
+    diagnostics.realloc(savedLabel, strings)
 
   # Replace previous with new one, or if first time, just save it in there.
   allocs[host_addr] = label
 
-def handle_free(allocs, output, label, extraFrees):
-  # Replace 'timestamp' key with 'timestamp_free'
-  label['timestamp_free'] = label['timestamp']
-  del label['timestamp']
+def record_realloc(others, savedLabel):
+  """
+  Adds the overwritten allocation `savedLabel` to the run-length history
+  `others`, creating the history if it is None. Returns the history.
+  """
+  if others is None:
+    others = {"count": 0, "dropped": 0, "runs": []}
 
-  # If we haven't seen an allocation for this free, add it to 'extraFrees'
-  host_addr = label['host_addr']
+  name, size = savedLabel.label, savedLabel.bytes
+  ts = savedLabel.timestamp_alloc
+  runs = others['runs']
+  others['count'] += 1
+  if runs and runs[-1][0] == name and runs[-1][1] == size:
+    runs[-1][2] += 1
+    runs[-1][4] = ts
+  else:
+    runs.append([name, size, 1, ts, ts])
+    if len(runs) > MAX_HISTORY_RUNS:
+      others['dropped'] += runs.pop(0)[2]
+
+  return others
+
+def handle_free(allocs, label, extraFrees, diagnostics, strings):
+  """
+  Returns the merged allocation for the free `label`, or None if the free has
+  no allocation, in which case it is added to `extraFrees`.
+  """
+  host_addr = label.host_addr
   if host_addr not in allocs:
-    printerr("No Alloc for Host Address:", host_addr)
+    diagnostics.rogue_free(label, strings)
     extraFrees.append(label)
-    return
+    return None
 
   # Merging
-  newLabel = allocs[host_addr]
-  newLabel['timestamp_free'] = label['timestamp_free']
-
-  del allocs[host_addr]
-  output.append(newLabel)
+  newLabel = allocs.pop(host_addr)
+  newLabel.timestamp_free = label.timestamp_free
+  return newLabel
 
 if __name__ == "__main__":
   def boolean(string):
@@ -146,7 +306,12 @@ if __name__ == "__main__":
   parser.add_argument("filename", nargs="?", metavar="mtrace.json",
       type=argparse.FileType('r'), default=sys.stdin,
       help="filename for mtrace json. leave empty to use standard input")
+  parser.add_argument("-v", "--verbose", action="store_true",
+      help="print every re-alloc and rogue free as it is seen")
+  parser.add_argument("--top", type=int, default=10,
+      help="number of most offending addresses to report (10)")
 
   args = parser.parse_args()
-  data = json.load(args.filename)
-  sys.exit(main(data, args.discard_allocs, args.discard_frees))
+  data = (item for _, _, item in tracefile.iter_json_array(args.filename))
+  diagnostics = Diagnostics(args.top, args.verbose)
+  sys.exit(main(data, args.discard_allocs, args.discard_frees, diagnostics))
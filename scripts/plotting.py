@@ -0,0 +1,45 @@
+"""
+Helpers shared by the plotting scripts (label_histo.py, alloc_graphs.py).
+"""
+
+import sys, json, csv
+import multiprocessing as mp
+
+# Imports pyplot on first use so that the summary path never loads matplotlib.
+def pyplot():
+  # Force matplotlib to not use any Xwindows backend.
+  import matplotlib
+  matplotlib.use('Agg')
+  import matplotlib.pyplot as plt
+  return plt
+
+# Renders the figures, given as (function, args) pairs, on a pool of `jobs`
+# processes. Each figure only gets its own arguments pickled over.
+def render_all(figures, jobs):
+  if jobs <= 1:
+    for function, args in figures: function(*args)
+    return
+
+  pool = mp.Pool(processes=min(jobs, len(figures)))
+  results = [pool.apply_async(function, args) for function, args in figures]
+  pool.close()
+  for result in results:
+    result.get() # re-raises any error from the worker
+  pool.join()
+
+# Writes the summary rows to `filename` as CSV if it ends in .csv and as JSON
+# otherwise. "-" writes to standard output.
+def write_summary(rows, fields, filename):
+  rows = [{k: v.item() if hasattr(v, "item") else v for k, v in row.items()}
+      for row in rows]
+  out = sys.stdout if filename == "-" else open(filename, 'w')
+  try:
+    if filename.endswith(".csv"):
+      writer = csv.DictWriter(out, fields)
+      writer.writeheader()
+      writer.writerows(rows)
+    else:
+      json.dump(rows, out, indent=2, sort_keys=True)
+      out.write("\n")
+  finally:
+    if out is not sys.stdout: out.close()
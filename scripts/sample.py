@@ -0,0 +1,125 @@
+#!/usr/bin/python
+"""
+This script downsamples a filtered mtrace json file (the output of filter.py)
+so that models can be run on a fraction of the trace for a quick, directional
+answer before committing to a full replay.
+
+Entries are kept or dropped by a hash of their address, so an allocation and
+its free are always kept or dropped together. Two sampling modes exist:
+  1) addr: every address is kept with probability `rate`.
+  2) label: each label is a stratum sampled at `rate`, except that small
+     labels are sampled at a higher rate so that at least `min_count` of their
+     entries are kept (all of them if they have fewer).
+
+Each sample is written to <prefix>.<n>.json along with a <prefix>.<n>.json.scale
+sidecar holding the factor by which each label's entries were thinned out.
+gcmodel.TraceRunner picks the sidecar up automatically and scales the model's
+time accordingly. Generating several samples (--samples) with different seeds
+lets estimate.py report error bounds.
+
+  ./sample.py --rate 0.05 --samples 5 filtered.json sample
+  cd ../models && ./estimate.py simple_malloc.SimpleMalloc ../scripts/sample.*.json
+"""
+
+from __future__ import print_function
+import sys, json, argparse, zlib
+import tracefile
+from trace_index import TraceIndex
+
+def printerr(*args):
+  print(*args, file=sys.stderr)
+
+def keep_fraction(seed, addr):
+  """ Maps (seed, addr) to a deterministic value in [0, 1). """
+  return (zlib.crc32("%d:%s" % (seed, addr)) & 0xffffffff) / float(2**32)
+
+def label_rates(filename, rate, min_count):
+  """ Returns each label's sampling rate for stratified sampling. """
+  counts = TraceIndex.load(filename).label_counts()
+  return {label: min(1.0, max(rate, float(min_count) / count))
+      for label, count in counts.items()}
+
+class Sample(object):
+  def __init__(self, filename, seed, by, rate, rates):
+    self.filename = filename
+    self.seed = seed
+    self.by = by
+    self.rate = rate
+    self.rates = rates
+    self.totals, self.kept = {}, {}
+    self.out = open(filename, 'w')
+    self.out.write("[")
+    self.empty = True
+
+  def offer(self, item):
+    name = item['name']
+    rate = self.rates.get(name, self.rate) if self.rates else self.rate
+    self.totals[name] = self.totals.get(name, 0) + 1
+    if keep_fraction(self.seed, item['addr']) >= rate:
+      return
+
+    self.kept[name] = self.kept.get(name, 0) + 1
+    if not self.empty: self.out.write(", ")
+    self.out.write(json.dumps(item))
+    self.empty = False
+
+  def close(self):
+    self.out.write("]\n")
+    self.out.close()
+
+    # labels that lost all of their entries can't be scaled; they fall back
+    # to the default scale
+    scale = {name: float(self.totals[name]) / self.kept[name]
+        for name in self.kept}
+    sidecar = {
+      "by": self.by,
+      "rate": self.rate,
+      "seed": self.seed,
+      "default_scale": 1.0 / self.rate,
+      "scale": scale,
+    }
+    with open(self.filename + ".scale", 'w') as f:
+      json.dump(sidecar, f)
+
+    kept, total = sum(self.kept.values()), sum(self.totals.values())
+    printerr("Wrote", self.filename, "(%d of %d entries)" % (kept, total))
+
+def main(args):
+  rates = None
+  if args.by == "label":
+    rates = label_rates(args.filename, args.rate, args.min_count)
+
+  samples = []
+  for n in range(args.samples):
+    filename = "%s.%d.json" % (args.prefix, n)
+    samples.append(Sample(filename, args.seed + n, args.by, args.rate, rates))
+
+  with open(args.filename, 'r') as f:
+    for _, _, item in tracefile.iter_json_array(f):
+      for sample in samples:
+        sample.offer(item)
+
+  for sample in samples:
+    sample.close()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("filename", metavar="filtered.json", type=str,
+      help="filename for filtered json. required")
+  parser.add_argument("prefix", type=str,
+      help="output prefix. samples are written to <prefix>.<n>.json")
+  parser.add_argument("--by", choices=["addr", "label"], default="addr",
+      help="sample addresses uniformly or stratified by label (addr)")
+  parser.add_argument("--rate", type=float, default=0.1,
+      help="fraction of addresses to keep (0.1)")
+  parser.add_argument("--min-count", type=int, default=100,
+      help="minimum entries kept per label when sampling by label (100)")
+  parser.add_argument("--samples", type=int, default=1,
+      help="number of independent samples to generate (1)")
+  parser.add_argument("--seed", type=int, default=0,
+      help="seed of the first sample; sample n uses seed + n (0)")
+
+  args = parser.parse_args()
+  if not 0 < args.rate <= 1:
+    parser.error("rate must be in (0, 1]")
+  sys.exit(main(args))
@@ -0,0 +1,216 @@
+#!/usr/bin/python
+"""
+This script computes per-label lifetime quantiles (median, p95, p99) from a
+merged mtrace json file in a single streaming pass and small, fixed memory, so
+that it works on traces too large for label_histo.py to hold every lifetime.
+
+Each label gets a KLL quantile sketch. A sketch keeps a few hundred values no
+matter how many it has seen, and the rank of any quantile it reports is,
+with 99% probability, off by at most the error reported next to it. Sketches of disjoint
+parts of a trace can be merged, so traces (or time windows of one trace, see
+trace_index.py) can be sketched by parallel workers and combined afterwards:
+
+  ./sketch.py build merged.json -o merged.sketch
+  ./sketch.py build part1.json -o part1.sketch   # on one worker
+  ./sketch.py build part2.json -o part2.sketch   # on another
+  ./sketch.py merge part1.sketch part2.sketch -o all.sketch
+  ./sketch.py show all.sketch
+"""
+
+from __future__ import print_function
+import sys, json, argparse, math, random
+import tracefile
+
+def printerr(*args):
+  print(*args, file=sys.stderr)
+
+class KLLSketch(object):
+  """
+  A mergeable streaming quantile sketch (Karnin, Lang, Liberty, 2016).
+
+  Values are kept in a hierarchy of compactors, where a value in compactor h
+  stands for 2^h of the values seen. When a compactor fills up, it is sorted
+  and every other value (starting at a random offset) is promoted to the next
+  compactor. The capacity of the compactors shrinks geometrically by `c` from
+  the top, so the sketch holds roughly k / (1 - c) values in total.
+
+  Every compaction at height h shifts the rank of any value by -2^h, 0, or
+  2^h with a mean of zero, independently of the other compactions. By
+  Hoeffding's inequality, the rank error of a quantile exceeds
+  sqrt(2 * ln(2 / delta) * sum(4^h)) with probability at most delta; the sketch
+  keeps sum(4^h) over its compactions to report that bound.
+  """
+  def __init__(self, k=200, c=2.0/3.0, seed=None):
+    self.k = k
+    self.c = c
+    self.count = 0 # number of values seen
+    self.min = self.max = None
+    self.error = 0 # sum of 4^h over all compactions
+    self.compactors = [[]]
+    self.random = random.Random(seed)
+    self._update_capacity()
+
+  def _capacity(self, h):
+    depth = len(self.compactors) - h - 1
+    return int(math.ceil(self.k * self.c**depth)) + 1
+
+  def _update_capacity(self):
+    self.size = sum(len(c) for c in self.compactors)
+    self.max_size = sum(self._capacity(h) for h in range(len(self.compactors)))
+
+  def update(self, value):
+    self.compactors[0].append(value)
+    self.size += 1
+    self.count += 1
+    if self.min is None or value < self.min: self.min = value
+    if self.max is None or value > self.max: self.max = value
+    if self.size >= self.max_size:
+      self._compress()
+
+  def _compress(self):
+    """ Compacts the lowest full compactors until the sketch fits. """
+    for h in range(len(self.compactors)):
+      if self.size < self.max_size: return
+      if len(self.compactors[h]) < self._capacity(h): continue
+
+      if h + 1 == len(self.compactors):
+        self.compactors.append([])
+        self._update_capacity()
+
+      values = sorted(self.compactors[h])
+      # an odd value out stays behind so that no weight is lost
+      leftover = [values.pop()] if len(values) % 2 else []
+      offset = self.random.randint(0, 1)
+      self.compactors[h + 1].extend(values[offset::2])
+      self.compactors[h] = leftover
+      self.error += 4**h
+      self._update_capacity()
+
+  def merge(self, other):
+    """ Folds the sketch `other` into this one. """
+    while len(self.compactors) < len(other.compactors):
+      self.compactors.append([])
+    for h, values in enumerate(other.compactors):
+      self.compactors[h].extend(values)
+
+    self.count += other.count
+    self.error += other.error
+    if other.min is not None:
+      self.min = other.min if self.min is None else min(self.min, other.min)
+      self.max = other.max if self.max is None else max(self.max, other.max)
+    self._update_capacity()
+    while self.size >= self.max_size:
+      self._compress()
+
+  def quantiles(self, qs):
+    """ Returns the approximate q-quantile for each q in `qs` (0 <= q <= 1). """
+    if self.count == 0: return [None for q in qs]
+
+    weighted = sorted((v, 2**h) for h, c in enumerate(self.compactors) for v in c)
+    total = float(sum(w for _, w in weighted))
+    results = []
+    for q in qs:
+      if q <= 0: results.append(self.min); continue
+      if q >= 1: results.append(self.max); continue
+      target, seen = q * total, 0
+      for value, weight in weighted:
+        seen += weight
+        if seen >= target: break
+      results.append(value)
+    return results
+
+  def quantile(self, q):
+    return self.quantiles([q])[0]
+
+  def rank_error(self, confidence=.99):
+    """
+    Returns a bound on the rank error of any one quantile, as a fraction of
+    the count, that holds with probability `confidence`.
+    """
+    if not self.count: return 0.0
+    delta = 1 - confidence
+    return math.sqrt(2 * math.log(2 / delta) * self.error) / self.count
+
+  def to_dict(self):
+    return {"k": self.k, "c": self.c, "count": self.count, "min": self.min,
+        "max": self.max, "error": self.error, "compactors": self.compactors}
+
+  @classmethod
+  def from_dict(cls, saved):
+    sketch = cls(saved["k"], saved["c"])
+    sketch.count, sketch.error = saved["count"], saved["error"]
+    sketch.min, sketch.max = saved["min"], saved["max"]
+    sketch.compactors = saved["compactors"]
+    sketch._update_capacity()
+    return sketch
+
+def sketch_lifetimes(data, k):
+  """ Returns a map from label name to a KLLSketch of its lifetimes (ms). """
+  sketches = {}
+  for item in data:
+    # skip extra allocs/frees
+    if 'extra' in item: continue
+
+    label = item['label']
+    if label not in sketches:
+      sketches[label] = KLLSketch(k)
+    lifetime = (item['timestamp_free'] - item['timestamp_alloc']) * 10**3
+    sketches[label].update(lifetime)
+  return sketches
+
+def save_sketches(sketches, filename):
+  with open(filename, 'w') as f:
+    json.dump({label: s.to_dict() for label, s in sketches.items()}, f)
+
+def load_sketches(filename):
+  with open(filename, 'r') as f:
+    saved = json.load(f)
+  return {label: KLLSketch.from_dict(s) for label, s in saved.items()}
+
+def merge_sketches(all_sketches):
+  merged = {}
+  for sketches in all_sketches:
+    for label, sketch in sketches.items():
+      if label in merged: merged[label].merge(sketch)
+      else: merged[label] = sketch
+  return merged
+
+def show_sketches(sketches):
+  print("%-32s %10s %12s %12s %12s %8s" %
+      ("label", "count", "median", "p95", "p99", "error"))
+  for label in sorted(sketches, key=lambda l: -sketches[l].count):
+    sketch = sketches[label]
+    median, p95, p99 = sketch.quantiles([.5, .95, .99])
+    print("%-32s %10d %12.4f %12.4f %12.4f %7.2f%%" % (label, sketch.count,
+        median, p95, p99, sketch.rank_error() * 100))
+
+def main(args):
+  if args.command == "build":
+    if len(args.filenames) != 1:
+      printerr("build takes exactly one merged trace")
+      return 1
+    with open(args.filenames[0], 'r') as f:
+      data = tracefile.iter_trace(f)
+      sketches = sketch_lifetimes(data, args.k)
+  else:
+    sketches = merge_sketches(load_sketches(f) for f in args.filenames)
+
+  if args.output:
+    save_sketches(sketches, args.output)
+  else:
+    show_sketches(sketches)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("command", choices=["build", "merge", "show"],
+      help="sketch a merged trace, merge saved sketches, or print sketches")
+  parser.add_argument("filenames", nargs="+", metavar="file",
+      help="a merged json or msgpack trace for build; saved sketches for "
+      "merge and show")
+  parser.add_argument("-o", "--output", type=str, default=None,
+      help="save the sketches to this file instead of printing them")
+  parser.add_argument("-k", type=int, default=200,
+      help="sketch size parameter; larger is more accurate (200)")
+
+  args = parser.parse_args()
+  sys.exit(main(args))
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+"""
+This script builds and queries an index sidecar for a raw, merged, or filtered
+mtrace json file so that a subset of the trace, say one label or one boot
+phase, can be extracted by seeking instead of re-parsing the whole trace.
+
+The index is written next to the trace as <trace>.idx and holds:
+  1) labels: for each label name, the byte offset and length of its entries.
+  2) blocks: the trace split into runs of `block_size` consecutive entries,
+     each with its starting offset and min/max timestamp. Time windows only
+     read the blocks they overlap. This works for merged traces too, which are
+     not sorted by time.
+
+The index remembers the trace's size and modification time and is rebuilt
+automatically when it is stale. Queries print a json array with the same
+shape as the trace, so the output can be fed straight into the analysis
+scripts:
+
+  ./trace_index.py build merged.json
+  ./trace_index.py query merged.json -l kmalloc-256 | ./label_histo.py
+  ./trace_index.py query filtered.json --start 1401904885 --end 1401904890
+"""
+
+from __future__ import print_function
+import sys, json, os, argparse, bisect
+import tracefile
+
+INDEX_VERSION = 1
+
+def printerr(*args):
+  print(*args, file=sys.stderr)
+
+def index_filename(filename):
+  return filename + ".idx"
+
+class TraceIndex(object):
+  def __init__(self, filename, block_size, blocks, labels):
+    self.filename = filename
+    self.block_size = block_size
+    self.blocks = blocks # [[offset, end offset, min ts, max ts], ...]
+    self.labels = labels # label -> {"offsets": [...], "lengths": [...]}
+    self.block_offsets = [b[0] for b in blocks]
+
+  @classmethod
+  def build(cls, filename, block_size=4096):
+    """ Scans the trace `filename` once and builds its index. """
+    blocks, labels = [], {}
+    block = None
+    with open(filename, 'r') as f:
+      for offset, length, item in tracefile.iter_json_array(f):
+        label = tracefile.event_label(item)
+        if label is not None:
+          if label not in labels:
+            labels[label] = {"offsets": [], "lengths": []}
+          labels[label]["offsets"].append(offset)
+          labels[label]["lengths"].append(length)
+
+        ts = tracefile.event_timestamp(item)
+        if block is None or block[4] == block_size:
+          block = [offset, offset + length, ts, ts, 0]
+          blocks.append(block)
+        block[1] = offset + length
+        block[4] += 1
+        if ts is not None:
+          block[2] = ts if block[2] is None else min(block[2], ts)
+          block[3] = ts if block[3] is None else max(block[3], ts)
+
+    blocks = [b[:4] for b in blocks]
+    return cls(filename, block_size, blocks, labels)
+
+  @classmethod
+  def load(cls, filename, block_size=4096):
+    """
+    Loads the index for the trace `filename`, building (and saving) it first
+    if it doesn't exist or is stale.
+    """
+    stat = os.stat(filename)
+    try:
+      with open(index_filename(filename), 'r') as f:
+        saved = json.load(f)
+      fresh = (saved["version"] == INDEX_VERSION and
+          saved["size"] == stat.st_size and saved["mtime"] == stat.st_mtime)
+    except (IOError, ValueError, KeyError):
+      fresh = False
+
+    if not fresh:
+      index = cls.build(filename, block_size)
+      index.save()
+      return index
+
+    return cls(filename, saved["block_size"], saved["blocks"], saved["labels"])
+
+  def save(self):
+    stat = os.stat(self.filename)
+    saved = {
+      "version": INDEX_VERSION,
+      "size": stat.st_size,
+      "mtime": stat.st_mtime,
+      "block_size": self.block_size,
+      "blocks": self.blocks,
+      "labels": self.labels,
+    }
+    with open(index_filename(self.filename), 'w') as f:
+      json.dump(saved, f)
+
+  def label_counts(self):
+    return {k: len(v["offsets"]) for k, v in self.labels.items()}
+
+  def _overlapping_blocks(self, start, end):
+    """ Returns the blocks that may hold entries in [start, end). """
+    def overlaps(b):
+      if b[2] is None: return False
+      return (start is None or b[3] >= start) and (end is None or b[2] < end)
+    return [b for b in self.blocks if overlaps(b)]
+
+  def query(self, labels=None, start=None, end=None):
+    """
+    Yields the trace entries with one of the given `labels` (all labels if
+    None) and a timestamp in [start, end) (unbounded if None), in file order.
+    """
+    def in_window(item):
+      ts = tracefile.event_timestamp(item)
+      if ts is None: return start is None and end is None
+      return (start is None or ts >= start) and (end is None or ts < end)
+
+    blocks = self._overlapping_blocks(start, end)
+    with open(self.filename, 'r') as f:
+      if labels is None:
+        for item in self._read_blocks(f, blocks):
+          if in_window(item): yield item
+        return
+
+      for offset, length in self._label_entries(labels, blocks):
+        f.seek(offset)
+        item = json.loads(f.read(length))
+        if in_window(item): yield item
+
+  def _label_entries(self, labels, blocks):
+    """ Returns (offset, length) of the entries for `labels` within `blocks`. """
+    entries = []
+    for label in labels:
+      if label not in self.labels: continue
+      entry = self.labels[label]
+      entries += zip(entry["offsets"], entry["lengths"])
+    entries.sort()
+
+    if len(blocks) == len(self.blocks):
+      return entries
+
+    # keep only the entries that fall within one of the overlapping blocks
+    starts = [b[0] for b in blocks]
+    def in_blocks(offset):
+      i = bisect.bisect_right(starts, offset) - 1
+      return i >= 0 and offset < blocks[i][1]
+    return [e for e in entries if in_blocks(e[0])]
+
+  def _read_blocks(self, f, blocks):
+    """ Yields the entries of `blocks`, seeking once per contiguous run. """
+    i = 0
+    while i < len(blocks):
+      # merge consecutive blocks into one read
+      j = i
+      while j + 1 < len(blocks) and blocks[j + 1][0] == self._next_offset(blocks[j]):
+        j += 1
+
+      f.seek(blocks[i][0])
+      data = "[" + f.read(blocks[j][1] - blocks[i][0]) + "]"
+      for item in json.loads(data):
+        yield item
+      i = j + 1
+
+  def _next_offset(self, block):
+    i = bisect.bisect_left(self.block_offsets, block[0])
+    if i + 1 < len(self.block_offsets): return self.block_offsets[i + 1]
+    return None
+
+def main(args):
+  if args.command == "build":
+    index = TraceIndex.build(args.filename, args.block_size)
+    index.save()
+    printerr("Indexed", len(index.labels), "labels in", len(index.blocks),
+        "blocks")
+  elif args.command == "labels":
+    index = TraceIndex.load(args.filename, args.block_size)
+    counts = index.label_counts()
+    for label in sorted(counts, key=lambda k: -counts[k]):
+      print("%-32s %d" % (label or "<unlabeled>", counts[label]))
+  else:
+    index = TraceIndex.load(args.filename, args.block_size)
+    items = index.query(args.labels, args.start, args.end)
+    tracefile.write_json_array(sys.stdout, items)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("command", choices=["build", "labels", "query"],
+      help="build the index, list the indexed labels, or extract a subset")
+  parser.add_argument("filename", metavar="trace.json", type=str,
+      help="filename for raw, merged, or filtered json. required")
+  parser.add_argument("-l", "--label", dest="labels", action="append",
+      help="label to extract. may be repeated. (all labels)")
+  parser.add_argument("--start", type=float, default=None,
+      help="only extract entries at or after this timestamp")
+  parser.add_argument("--end", type=float, default=None,
+      help="only extract entries before this timestamp")
+  parser.add_argument("--block-size", type=int, default=4096,
+      help="number of entries per timestamp index block (4096)")
+
+  args = parser.parse_args()
+  sys.exit(main(args))
@@ -0,0 +1,284 @@
+"""
+Helpers for reading mtrace JSON traces (raw, merged, or filtered) without
+loading the whole file into memory.
+
+All of the traces produced by m2json, merge.py and filter.py are a single JSON
+array of objects. iter_json_array walks such an array element by element,
+reporting the byte offset and length of each element in the file so that
+callers (like trace_index.py) can later seek straight to it. write_json_array
+is its streaming counterpart for output.
+
+Traces can also be converted to msgpack with json_to_msgpack.py, which is
+smaller on disk. iter_trace reads either format, telling them apart by the
+file's extension or first byte, and streams msgpack traces element by element
+with umsgpack.unpack_array.
+
+Filtered traces are converted to a compact msgpack encoding (CompactWriter)
+instead of one map per entry. The msgpack array starts with a header map naming
+the format and the fields, and then holds:
+  1) Ext(STRING_EXT, utf-8 name): the next entry of the trace's string table,
+     written right before the first entry that uses it.
+  2) [dt, type, bytes, name, addr]: an entry, where `dt` is the number of
+     microseconds since the previous entry, `name` is an index into the string
+     table, and `addr` is the address as an int.
+Timestamps that aren't a whole number of microseconds are stored as the float
+itself in place of `dt`, and addresses that don't round-trip through
+format_addr are stored as strings, so the encoding is lossless. iter_trace
+decodes compact traces back into the usual entry dicts.
+
+To keep memory low, the preprocessing scripts don't hold on to the strings of
+the trace: label names are interned into small integer ids with a StringTable
+and hex addresses are parsed into ints with parse_addr as they are read.
+"""
+
+import json, re, os, itertools
+import umsgpack
+
+_decoder = json.JSONDecoder()
+_separator = re.compile(r'[ \t\n\r,]*')
+
+def iter_json_array(f, chunk_size=1 << 20):
+  """
+  Yields (offset, length, element) for each element of the JSON array in the
+  file object `f`, where `offset` and `length` locate the element's text in
+  the file. The file is read `chunk_size` bytes at a time.
+  """
+  buf, base, pos, eof = "", 0, 0, False
+
+  def refill(buf, base, pos):
+    data = f.read(chunk_size)
+    return buf[pos:] + data, base + pos, 0, not data
+
+  # find the opening bracket
+  while True:
+    pos = _separator.match(buf, pos).end()
+    if pos < len(buf) or eof: break
+    buf, base, pos, eof = refill(buf, base, pos)
+  if buf[pos:pos + 1] != "[":
+    raise ValueError("trace is not a JSON array")
+  pos += 1
+
+  while True:
+    pos = _separator.match(buf, pos).end()
+    if pos == len(buf):
+      if eof: raise ValueError("unterminated JSON array")
+      buf, base, pos, eof = refill(buf, base, pos)
+      continue
+
+    if buf[pos] == "]":
+      return
+
+    # an element that runs to the end of the buffer may have been cut short
+    try:
+      obj, end = _decoder.raw_decode(buf, pos)
+    except ValueError:
+      if eof: raise
+      end = len(buf)
+    if end == len(buf) and not eof:
+      buf, base, pos, eof = refill(buf, base, pos)
+      continue
+
+    yield base + pos, end - pos, obj
+    pos = end
+
+def write_json_array(out, items):
+  """ Writes the elements of the iterable `items` to `out` as a json array. """
+  out.write("[")
+  first = True
+  for item in items:
+    if not first: out.write(", ")
+    out.write(json.dumps(item))
+    first = False
+  out.write("]\n")
+
+MSGPACK_EXTENSION = ".msgpack"
+
+# the first byte of a msgpack array: fixarray, array 16 or array 32
+_MSGPACK_ARRAY_CODES = set(chr(c) for c in range(0x90, 0xa0)) | set("\xdc\xdd")
+
+class _PeekedFile(object):
+  """ A file object that returns `head` before reading the rest of `f`. """
+  def __init__(self, f, head):
+    self.f, self.head = f, head
+
+  def read(self, n=-1):
+    if not self.head: return self.f.read(n)
+    if n < 0:
+      data, self.head = self.head + self.f.read(), ""
+    else:
+      data, self.head = self.head[:n], self.head[n:]
+      if len(data) < n: data += self.f.read(n - len(data))
+    return data
+
+def open_trace(f):
+  """
+  Returns (is_msgpack, file object) for the trace in the file object `f`,
+  whose format is detected from its extension, or else its first byte. The
+  returned file object reads the trace from the start.
+  """
+  name = getattr(f, "name", "")
+  if isinstance(name, str) and os.path.splitext(name)[1] == MSGPACK_EXTENSION:
+    return True, f
+
+  try:
+    start = f.tell()
+    head = f.read(1)
+    f.seek(start)
+  except (IOError, AttributeError):
+    # not seekable (a pipe): hand the byte back on the next read
+    head = f.read(1)
+    f = _PeekedFile(f, head)
+  return head in _MSGPACK_ARRAY_CODES, f
+
+def iter_trace(f, int_addrs=False):
+  """
+  Yields each element of the json or msgpack trace in the file object `f`.
+  With `int_addrs`, the addresses of filtered entries are parsed into ints.
+  """
+  is_msgpack, f = open_trace(f)
+  if is_msgpack:
+    elements = umsgpack.unpack_array(f)
+    first = next(elements, None)
+    if is_compact_header(first):
+      for item in iter_compact(elements, first, int_addrs):
+        yield item
+      return
+    items = itertools.chain([first] if first is not None else [], elements)
+  else:
+    items = (item for _, _, item in iter_json_array(f))
+
+  if not int_addrs:
+    for item in items:
+      yield item
+    return
+  for item in items:
+    if 'addr' in item: item['addr'] = int_addr(item['addr'])
+    yield item
+
+COMPACT_FORMAT = "autogc-compact-trace"
+COMPACT_VERSION = 1
+COMPACT_FIELDS = ["timestamp", "type", "bytes", "name", "addr"]
+STRING_EXT = 1
+TIME_UNIT = 10**6 # compact timestamps count microseconds
+
+def is_compact_entry(item):
+  """ Returns whether `item` can be written by CompactWriter (a filtered entry). """
+  return isinstance(item, dict) and sorted(item) == sorted(COMPACT_FIELDS)
+
+class CompactWriter(object):
+  """ Writes filtered trace entries to the file `out` in the compact encoding. """
+  def __init__(self, out):
+    self.packer = umsgpack.ArrayPacker(out)
+    self.packer.pack({u"format": COMPACT_FORMAT, u"version": COMPACT_VERSION,
+        u"fields": COMPACT_FIELDS, u"time_unit": TIME_UNIT})
+    self.strings = StringTable()
+    self.time = 0
+    self.count = 0
+
+  def write(self, item):
+    if not is_compact_entry(item):
+      raise ValueError("not a filtered trace entry: %r" % (item,))
+
+    name = item['name']
+    if name is not None:
+      if name not in self.strings.ids:
+        self.packer.pack(umsgpack.Ext(STRING_EXT, name.encode('utf-8')))
+      name = self.strings.intern(name)
+
+    ts = item['timestamp']
+    time = int(round(ts * TIME_UNIT))
+    dt = time - self.time if float(time) / TIME_UNIT == ts else ts
+    self.time = time
+
+    addr = item['addr']
+    if isinstance(addr, basestring) and format_addr(parse_addr(addr)) == addr:
+      addr = parse_addr(addr)
+
+    self.packer.pack([dt, item['type'], item['bytes'], name, addr])
+    self.count += 1
+
+  def close(self):
+    self.packer.close()
+
+def is_compact_header(item):
+  if not isinstance(item, dict) or item.get("format") != COMPACT_FORMAT:
+    return False
+  if item["version"] > COMPACT_VERSION:
+    raise ValueError("compact trace version %d is newer than %d" %
+        (item["version"], COMPACT_VERSION))
+  return True
+
+def iter_compact(elements, header, int_addrs=False):
+  """
+  Yields the entries, as dicts, of the compact trace `elements` (the elements
+  following its `header`), with int addresses if `int_addrs` is set.
+  """
+  unit = float(header["time_unit"])
+  strings, time = [], 0
+  for element in elements:
+    if isinstance(element, umsgpack.Ext):
+      strings.append(element.data.decode('utf-8'))
+      continue
+
+    dt, item_type, size, name, addr = element
+    if isinstance(dt, float):
+      ts, time = dt, int(round(dt * unit))
+    else:
+      time += dt
+      ts = time / unit
+    if name is not None: name = strings[name]
+    if int_addrs:
+      if isinstance(addr, basestring): addr = int_addr(addr)
+    elif not isinstance(addr, basestring):
+      addr = format_addr(addr)
+    yield {"timestamp": ts, "type": item_type, "bytes": size, "name": name,
+        "addr": addr}
+
+class StringTable(object):
+  """ Interns strings into small integer ids, assigned in order of first use. """
+  def __init__(self):
+    self.ids = {}
+    self.strings = []
+
+  def intern(self, string):
+    id = self.ids.get(string)
+    if id is None:
+      id = self.ids[string] = len(self.strings)
+      self.strings.append(string)
+    return id
+
+  def __getitem__(self, id):
+    return self.strings[id]
+
+  def __len__(self):
+    return len(self.strings)
+
+def parse_addr(addr):
+  """ Converts a hex address string, eg '0x7fbc293c6e00', into an int. """
+  return int(addr, 16)
+
+def format_addr(addr):
+  """ Converts an int address back into the trace's hex string form. """
+  return "0x%x" % addr
+
+def int_addr(addr):
+  """ Returns `addr` as an int if it's a hex address string, else unchanged. """
+  if isinstance(addr, basestring):
+    try:
+      return int(addr, 16)
+    except ValueError:
+      pass
+  return addr
+
+def event_label(item):
+  """ Returns the label name of a raw/merged ('label') or filtered ('name') item. """
+  return item['label'] if 'label' in item else item.get('name')
+
+def event_timestamp(item):
+  """
+  Returns the timestamp of a raw/filtered item, or of a merged item's allocation
+  (or free, for rogue frees).
+  """
+  if 'timestamp' in item: return item['timestamp']
+  if 'timestamp_alloc' in item: return item['timestamp_alloc']
+  return item.get('timestamp_free')
@@ -41,6 +41,11 @@ latest MessagePack specification.com/msgpack/msgpack/blob/master/spec.md). In
 particular, it supports the new binary, UTF-8 string, and application ext
 types.
 
+In addition to packb()/unpackb(), pack()/unpack() serialize to and from file
+objects, and ArrayPacker/unpack_array() stream the elements of a top-level
+array one at a time, so multi-gigabyte arrays can be written and read in
+constant memory.
+
 License: MIT
 """
 
@@ -50,6 +55,7 @@ version = (1,6)
 import struct
 import collections
 import sys
+import io
 
 ################################################################################
 
@@ -165,9 +171,13 @@ KeyDuplicateException = DuplicateKeyException
 ################################################################################
 
 # Exported functions and variables set in __init()
+pack = None
 packb = None
+unpack = None
 unpackb = None
+dump = None
 dumps = None
+load = None
 loads = None
 
 compatibility = False
@@ -189,255 +199,422 @@ b'\x92\xabsome string\xaasome bytes'
 >>>
 """
 
+# Maximum number of map keys whose encoding and decoding are cached
+_KEY_CACHE_SIZE = 1024
+
 ################################################################################
 
-# You may notice struct.pack("B", x) instead of the simpler chr(x) in the code
+# You may notice _uint8.pack(x) instead of the simpler chr(x) in the code
 # below. This is to allow for seamless Python 2 and 3 compatibility, as chr(x)
 # has a str return type instead of bytes in Python 3, and struct.pack(...) has
 # the right return type in both versions.
-
-def _pack_integer(x):
+#
+# The struct formats are compiled once here rather than parsed on every call.
+_int8 = struct.Struct("b")
+_uint8 = struct.Struct("B")
+_int16 = struct.Struct(">h")
+_uint16 = struct.Struct(">H")
+_int32 = struct.Struct(">i")
+_uint32 = struct.Struct(">I")
+_int64 = struct.Struct(">q")
+_uint64 = struct.Struct(">Q")
+_float32 = struct.Struct(">f")
+_float64 = struct.Struct(">d")
+_ext8_header = struct.Struct("BB")
+_ext16_header = struct.Struct(">HB")
+_ext32_header = struct.Struct(">IB")
+
+def _pack_integer(x, fp):
     if x < 0:
         if x >= -32:
-            return struct.pack("b", x)
+            fp.write(_int8.pack(x))
         elif x >= -2**(8-1):
-            return b"\xd0" + struct.pack("b", x)
+            fp.write(b"\xd0" + _int8.pack(x))
         elif x >= -2**(16-1):
-            return b"\xd1" + struct.pack(">h", x)
+            fp.write(b"\xd1" + _int16.pack(x))
         elif x >= -2**(32-1):
-            return b"\xd2" + struct.pack(">i", x)
+            fp.write(b"\xd2" + _int32.pack(x))
         elif x >= -2**(64-1):
-            return b"\xd3" + struct.pack(">q", x)
+            fp.write(b"\xd3" + _int64.pack(x))
         else:
             raise UnsupportedTypeException("huge signed int")
     else:
         if x <= 127:
-            return struct.pack("B", x)
+            fp.write(_uint8.pack(x))
         elif x <= 2**8-1:
-            return b"\xcc" + struct.pack("B", x)
+            fp.write(b"\xcc" + _uint8.pack(x))
         elif x <= 2**16-1:
-            return b"\xcd" + struct.pack(">H", x)
+            fp.write(b"\xcd" + _uint16.pack(x))
         elif x <= 2**32-1:
-            return b"\xce" + struct.pack(">I", x)
+            fp.write(b"\xce" + _uint32.pack(x))
         elif x <= 2**64-1:
-            return b"\xcf" + struct.pack(">Q", x)
+            fp.write(b"\xcf" + _uint64.pack(x))
         else:
             raise UnsupportedTypeException("huge unsigned int")
 
-def _pack_nil(x):
-    return b"\xc0"
+def _pack_nil(x, fp):
+    fp.write(b"\xc0")
 
-def _pack_boolean(x):
-    return b"\xc3" if x else b"\xc2"
+def _pack_boolean(x, fp):
+    fp.write(b"\xc3" if x else b"\xc2")
 
-def _pack_float(x):
+def _pack_float(x, fp):
     if _float_size == 64:
-        return b"\xcb" + struct.pack(">d", x)
+        fp.write(b"\xcb" + _float64.pack(x))
     else:
-        return b"\xca" + struct.pack(">f", x)
+        fp.write(b"\xca" + _float32.pack(x))
 
-def _pack_string(x):
+def _pack_string(x, fp):
     x = x.encode('utf-8')
     if len(x) <= 31:
-        return struct.pack("B", 0xa0 | len(x)) + x
+        fp.write(_uint8.pack(0xa0 | len(x)) + x)
     elif len(x) <= 2**8-1:
-        return b"\xd9" + struct.pack("B", len(x)) + x
+        fp.write(b"\xd9" + _uint8.pack(len(x)) + x)
     elif len(x) <= 2**16-1:
-        return b"\xda" + struct.pack(">H", len(x)) + x
+        fp.write(b"\xda" + _uint16.pack(len(x)) + x)
     elif len(x) <= 2**32-1:
-        return b"\xdb" + struct.pack(">I", len(x)) + x
+        fp.write(b"\xdb" + _uint32.pack(len(x)) + x)
     else:
         raise UnsupportedTypeException("huge string")
 
-def _pack_binary(x):
+def _pack_binary(x, fp):
     if len(x) <= 2**8-1:
-        return b"\xc4" + struct.pack("B", len(x)) + x
+        fp.write(b"\xc4" + _uint8.pack(len(x)) + x)
     elif len(x) <= 2**16-1:
-        return b"\xc5" + struct.pack(">H", len(x)) + x
+        fp.write(b"\xc5" + _uint16.pack(len(x)) + x)
     elif len(x) <= 2**32-1:
-        return b"\xc6" + struct.pack(">I", len(x)) + x
+        fp.write(b"\xc6" + _uint32.pack(len(x)) + x)
     else:
         raise UnsupportedTypeException("huge binary string")
 
-def _pack_oldspec_raw(x):
+def _pack_oldspec_raw(x, fp):
     if len(x) <= 31:
-        return struct.pack("B", 0xa0 | len(x)) + x
+        fp.write(_uint8.pack(0xa0 | len(x)) + x)
     elif len(x) <= 2**16-1:
-        return b"\xda" + struct.pack(">H", len(x)) + x
+        fp.write(b"\xda" + _uint16.pack(len(x)) + x)
     elif len(x) <= 2**32-1:
-        return b"\xdb" + struct.pack(">I", len(x)) + x
+        fp.write(b"\xdb" + _uint32.pack(len(x)) + x)
     else:
         raise UnsupportedTypeException("huge raw string")
 
-def _pack_ext(x):
+def _pack_ext(x, fp):
     if len(x.data) == 1:
-        return b"\xd4" + struct.pack("B", x.type & 0xff) + x.data
+        fp.write(b"\xd4" + _uint8.pack(x.type & 0xff) + x.data)
     elif len(x.data) == 2:
-        return b"\xd5" + struct.pack("B", x.type & 0xff) + x.data
+        fp.write(b"\xd5" + _uint8.pack(x.type & 0xff) + x.data)
     elif len(x.data) == 4:
-        return b"\xd6" + struct.pack("B", x.type & 0xff) + x.data
+        fp.write(b"\xd6" + _uint8.pack(x.type & 0xff) + x.data)
     elif len(x.data) == 8:
-        return b"\xd7" + struct.pack("B", x.type & 0xff) + x.data
+        fp.write(b"\xd7" + _uint8.pack(x.type & 0xff) + x.data)
     elif len(x.data) == 16:
-        return b"\xd8" + struct.pack("B", x.type & 0xff) + x.data
+        fp.write(b"\xd8" + _uint8.pack(x.type & 0xff) + x.data)
     elif len(x.data) <= 2**8-1:
-        return b"\xc7" + struct.pack("BB", len(x.data), x.type & 0xff) + x.data
+        fp.write(b"\xc7" + _ext8_header.pack(len(x.data), x.type & 0xff) + x.data)
     elif len(x.data) <= 2**16-1:
-        return b"\xc8" + struct.pack(">HB", len(x.data), x.type & 0xff) + x.data
+        fp.write(b"\xc8" + _ext16_header.pack(len(x.data), x.type & 0xff) + x.data)
     elif len(x.data) <= 2**32-1:
-        return b"\xc9" + struct.pack(">IB", len(x.data), x.type & 0xff) + x.data
+        fp.write(b"\xc9" + _ext32_header.pack(len(x.data), x.type & 0xff) + x.data)
     else:
         raise UnsupportedTypeException("huge ext data")
 
-def _pack_array(x):
-    if len(x) <= 15:
-        s = struct.pack("B", 0x90 | len(x))
-    elif len(x) <= 2**16-1:
-        s = b"\xdc" + struct.pack(">H", len(x))
-    elif len(x) <= 2**32-1:
-        s = b"\xdd" + struct.pack(">I", len(x))
+def _pack_array_header(length, fp):
+    if length <= 15:
+        fp.write(_uint8.pack(0x90 | length))
+    elif length <= 2**16-1:
+        fp.write(b"\xdc" + _uint16.pack(length))
+    elif length <= 2**32-1:
+        fp.write(b"\xdd" + _uint32.pack(length))
     else:
         raise UnsupportedTypeException("huge array")
 
+def _pack_array(x, fp):
+    _pack_array_header(len(x), fp)
     for e in x:
-        s += packb(e)
+        pack(e, fp)
 
-    return s
-
-def _pack_map(x):
+def _pack_map(x, fp):
     if len(x) <= 15:
-        s = struct.pack("B", 0x80 | len(x))
+        fp.write(_uint8.pack(0x80 | len(x)))
     elif len(x) <= 2**16-1:
-        s = b"\xde" + struct.pack(">H", len(x))
+        fp.write(b"\xde" + _uint16.pack(len(x)))
     elif len(x) <= 2**32-1:
-        s = b"\xdf" + struct.pack(">I", len(x))
+        fp.write(b"\xdf" + _uint32.pack(len(x)))
     else:
         raise UnsupportedTypeException("huge array")
 
     for k,v in x.items():
-        s += packb(k)
-        s += packb(v)
-
-    return s
+        # Maps of the same shape repeat the same keys, so the encodings of
+        # short string keys are cached (they are the same in compatibility
+        # mode)
+        packed = _packed_keys.get(k) if k.__class__ is _text_type else None
+        if packed is not None:
+            fp.write(packed)
+        else:
+            _pack_key(k, fp)
+        pack(v, fp)
+
+def _pack_key(k, fp):
+    if k.__class__ is not _text_type or len(_packed_keys) >= _KEY_CACHE_SIZE:
+        pack(k, fp)
+        return
+    packed = k.encode('utf-8')
+    if len(packed) > 31:
+        pack(k, fp)
+        return
+    packed = _uint8.pack(0xa0 | len(packed)) + packed
+    _packed_keys[k] = packed
+    fp.write(packed)
 
 # Pack for Python 2, with 'unicode' type, 'str' type, and 'long' type
-def _packb2(x):
+def _pack2(x, fp):
     """
-    Serialize a Python object into MessagePack bytes.
+    Serialize a Python object into MessagePack bytes, writing them to a file
+    object.
 
     Args:
         x: Python object
+        fp: a .write()-supporting file object
 
     Returns:
-        A 'str' containing the serialized bytes.
+        None.
 
     Raises:
         UnsupportedType(PackException):
             Object type not supported for packing.
 
     Example:
-    >>> umsgpack.packb({u"compact": True, u"schema": 0})
-    '\x82\xa7compact\xc3\xa6schema\x00'
+    >>> f = open('test.bin', 'wb')
+    >>> umsgpack.pack({u"compact": True, u"schema": 0}, f)
     >>>
     """
     global compatibility
 
+    # Exact built-in types are dispatched with one table lookup; subclasses
+    # and compatibility mode take the isinstance() checks below
+    if not compatibility:
+        packer = _pack_dispatch_table.get(x.__class__)
+        if packer is not None:
+            packer(x, fp)
+            return
+
     if x is None:
-        return _pack_nil(x)
+        _pack_nil(x, fp)
     elif isinstance(x, bool):
-        return _pack_boolean(x)
+        _pack_boolean(x, fp)
     elif isinstance(x, int) or isinstance(x, long):
-        return _pack_integer(x)
+        _pack_integer(x, fp)
     elif isinstance(x, float):
-        return _pack_float(x)
+        _pack_float(x, fp)
     elif compatibility and isinstance(x, unicode):
-        return _pack_oldspec_raw(bytes(x))
+        _pack_oldspec_raw(bytes(x), fp)
     elif compatibility and isinstance(x, bytes):
-        return _pack_oldspec_raw(x)
+        _pack_oldspec_raw(x, fp)
     elif isinstance(x, unicode):
-        return _pack_string(x)
+        _pack_string(x, fp)
     elif isinstance(x, str):
-        return _pack_binary(x)
+        _pack_binary(x, fp)
     elif isinstance(x, list) or isinstance(x, tuple):
-        return _pack_array(x)
+        _pack_array(x, fp)
     elif isinstance(x, dict):
-        return _pack_map(x)
+        _pack_map(x, fp)
     elif isinstance(x, Ext):
-        return _pack_ext(x)
+        _pack_ext(x, fp)
     else:
         raise UnsupportedTypeException("unsupported type: %s" % str(type(x)))
 
 # Pack for Python 3, with unicode 'str' type, 'bytes' type, and no 'long' type
-def _packb3(x):
+def _pack3(x, fp):
     """
-    Serialize a Python object into MessagePack bytes.
+    Serialize a Python object into MessagePack bytes, writing them to a file
+    object.
 
     Args:
         x: Python object
+        fp: a .write()-supporting file object
 
     Returns:
-        A 'bytes' containing the serialized bytes.
+        None.
 
     Raises:
         UnsupportedType(PackException):
             Object type not supported for packing.
 
     Example:
-    >>> umsgpack.packb({u"compact": True, u"schema": 0})
-    b'\x82\xa7compact\xc3\xa6schema\x00'
+    >>> f = open('test.bin', 'wb')
+    >>> umsgpack.pack({u"compact": True, u"schema": 0}, f)
     >>>
     """
     global compatibility
 
+    # Exact built-in types are dispatched with one table lookup; subclasses
+    # and compatibility mode take the isinstance() checks below
+    if not compatibility:
+        packer = _pack_dispatch_table.get(x.__class__)
+        if packer is not None:
+            packer(x, fp)
+            return
+
     if x is None:
-        return _pack_nil(x)
+        _pack_nil(x, fp)
     elif isinstance(x, bool):
-        return _pack_boolean(x)
+        _pack_boolean(x, fp)
     elif isinstance(x, int):
-        return _pack_integer(x)
+        _pack_integer(x, fp)
     elif isinstance(x, float):
-        return _pack_float(x)
+        _pack_float(x, fp)
     elif compatibility and isinstance(x, str):
-        return _pack_oldspec_raw(x.encode('utf-8'))
+        _pack_oldspec_raw(x.encode('utf-8'), fp)
     elif compatibility and isinstance(x, bytes):
-        return _pack_oldspec_raw(x)
+        _pack_oldspec_raw(x, fp)
     elif isinstance(x, str):
-        return _pack_string(x)
+        _pack_string(x, fp)
     elif isinstance(x, bytes):
-        return _pack_binary(x)
+        _pack_binary(x, fp)
     elif isinstance(x, list) or isinstance(x, tuple):
-        return _pack_array(x)
+        _pack_array(x, fp)
     elif isinstance(x, dict):
-        return _pack_map(x)
+        _pack_map(x, fp)
     elif isinstance(x, Ext):
-        return _pack_ext(x)
+        _pack_ext(x, fp)
     else:
         raise UnsupportedTypeException("unsupported type: %s" % str(type(x)))
 
+# Pack into bytes for Python 2
+def _packb2(x):
+    """
+    Serialize a Python object into MessagePack bytes.
+
+    Args:
+        x: Python object
+
+    Returns:
+        A 'str' containing the serialized bytes.
+
+    Raises:
+        UnsupportedType(PackException):
+            Object type not supported for packing.
+
+    Example:
+    >>> umsgpack.packb({u"compact": True, u"schema": 0})
+    '\x82\xa7compact\xc3\xa6schema\x00'
+    >>>
+    """
+    fp = io.BytesIO()
+    _pack2(x, fp)
+    return fp.getvalue()
+
+# Pack into bytes for Python 3
+def _packb3(x):
+    """
+    Serialize a Python object into MessagePack bytes.
+
+    Args:
+        x: Python object
+
+    Returns:
+        A 'bytes' containing the serialized bytes.
+
+    Raises:
+        UnsupportedType(PackException):
+            Object type not supported for packing.
+
+    Example:
+    >>> umsgpack.packb({u"compact": True, u"schema": 0})
+    b'\x82\xa7compact\xc3\xa6schema\x00'
+    >>>
+    """
+    fp = io.BytesIO()
+    _pack3(x, fp)
+    return fp.getvalue()
+
+class ArrayPacker:
+    """
+    The ArrayPacker class writes a MessagePack array to a file object one
+    element at a time, so that arrays too large to hold in memory (or produced
+    by a generator) can be serialized in constant memory.
+    """
+
+    def __init__(self, fp, length=None):
+        """
+        Construct a new ArrayPacker and write the array header.
+
+        Args:
+            fp: a .write()-supporting file object
+            length: the number of elements that will be packed, if known. If
+                None, fp must also support .seek() and .tell(): a 32-bit
+                length is reserved in the header and filled in by close().
+
+        Raises:
+            UnsupportedType(PackException):
+                Array length too large for MessagePack.
+
+        Example:
+        >>> f = open('test.bin', 'wb')
+        >>> with umsgpack.ArrayPacker(f) as packer:
+        ...     for x in range(1000):
+        ...         packer.pack(x)
+        ...
+        >>>
+        """
+        self.fp = fp
+        self.length = length
+        self.count = 0
+        if length is None:
+            self.header_offset = fp.tell()
+            fp.write(b"\xdd" + _uint32.pack(0))
+        else:
+            _pack_array_header(length, fp)
+
+    def pack(self, x):
+        """
+        Serialize a Python object as the next element of the array.
+        """
+        pack(x, self.fp)
+        self.count += 1
+
+    def close(self):
+        """
+        Finish the array, filling in its length if it was not given.
+
+        Raises:
+            PackException:
+                The number of packed elements does not match the given length.
+            UnsupportedType(PackException):
+                Array length too large for MessagePack.
+        """
+        if self.length is not None:
+            if self.count != self.length:
+                raise PackException("packed %d of %d array elements" %
+                                    (self.count, self.length))
+            return
+        if self.count > 2**32-1:
+            raise UnsupportedTypeException("huge array")
+
+        end = self.fp.tell()
+        self.fp.seek(self.header_offset + 1)
+        self.fp.write(_uint32.pack(self.count))
+        self.fp.seek(end)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+
 ################################################################################
 
-def _unpack_integer(code, read_fn):
-    if (ord(code) & 0xe0) == 0xe0:
-        return struct.unpack("b", code)[0]
-    elif code == b'\xd0':
-        return struct.unpack("b", read_fn(1))[0]
-    elif code == b'\xd1':
-        return struct.unpack(">h", read_fn(2))[0]
-    elif code == b'\xd2':
-        return struct.unpack(">i", read_fn(4))[0]
-    elif code == b'\xd3':
-        return struct.unpack(">q", read_fn(8))[0]
-    elif (ord(code) & 0x80) == 0x00:
-        return struct.unpack("B", code)[0]
-    elif code == b'\xcc':
-        return struct.unpack("B", read_fn(1))[0]
-    elif code == b'\xcd':
-        return struct.unpack(">H", read_fn(2))[0]
-    elif code == b'\xce':
-        return struct.unpack(">I", read_fn(4))[0]
-    elif code == b'\xcf':
-        return struct.unpack(">Q", read_fn(8))[0]
-    raise Exception("logic error, not int: 0x%02x" % ord(code))
+def _unpack_positive_fixint(code, read_fn):
+    return ord(code)
+
+def _unpack_negative_fixint(code, read_fn):
+    return ord(code) - 0x100
+
+def _unpack_struct(s):
+    # Returns an unpacking function for a code followed by a fixed-size value
+    def unpack(code, read_fn):
+        return s.unpack(read_fn(s.size))[0]
+    return unpack
 
 def _unpack_reserved(code, read_fn):
     if code == b'\xc1':
@@ -456,22 +633,15 @@ def _unpack_boolean(code, read_fn):
         return True
     raise Exception("logic error, not boolean: 0x%02x" % ord(code))
 
-def _unpack_float(code, read_fn):
-    if code == b'\xca':
-        return struct.unpack(">f", read_fn(4))[0]
-    elif code == b'\xcb':
-        return struct.unpack(">d", read_fn(8))[0]
-    raise Exception("logic error, not float: 0x%02x" % ord(code))
-
 def _unpack_string(code, read_fn):
     if (ord(code) & 0xe0) == 0xa0:
         length = ord(code) & ~0xe0
     elif code == b'\xd9':
-        length = struct.unpack("B", read_fn(1))[0]
+        length = _uint8.unpack(read_fn(1))[0]
     elif code == b'\xda':
-        length = struct.unpack(">H", read_fn(2))[0]
+        length = _uint16.unpack(read_fn(2))[0]
     elif code == b'\xdb':
-        length = struct.unpack(">I", read_fn(4))[0]
+        length = _uint32.unpack(read_fn(4))[0]
     else:
         raise Exception("logic error, not string: 0x%02x" % ord(code))
 
@@ -487,11 +657,11 @@ def _unpack_string(code, read_fn):
 
 def _unpack_binary(code, read_fn):
     if code == b'\xc4':
-        length = struct.unpack("B", read_fn(1))[0]
+        length = _uint8.unpack(read_fn(1))[0]
     elif code == b'\xc5':
-        length = struct.unpack(">H", read_fn(2))[0]
+        length = _uint16.unpack(read_fn(2))[0]
     elif code == b'\xc6':
-        length = struct.unpack(">I", read_fn(4))[0]
+        length = _uint32.unpack(read_fn(4))[0]
     else:
         raise Exception("logic error, not binary: 0x%02x" % ord(code))
 
@@ -509,69 +679,164 @@ def _unpack_ext(code, read_fn):
     elif code == b'\xd8':
         length = 16
     elif code == b'\xc7':
-        length = struct.unpack("B", read_fn(1))[0]
+        length = _uint8.unpack(read_fn(1))[0]
     elif code == b'\xc8':
-        length = struct.unpack(">H", read_fn(2))[0]
+        length = _uint16.unpack(read_fn(2))[0]
     elif code == b'\xc9':
-        length = struct.unpack(">I", read_fn(4))[0]
+        length = _uint32.unpack(read_fn(4))[0]
     else:
         raise Exception("logic error, not ext: 0x%02x" % ord(code))
 
     return Ext(ord(read_fn(1)), read_fn(length))
 
-def _unpack_array(code, read_fn):
+def _unpack_array_length(code, read_fn):
     if (ord(code) & 0xf0) == 0x90:
-        length = (ord(code) & ~0xf0)
+        return (ord(code) & ~0xf0)
     elif code == b'\xdc':
-        length = struct.unpack(">H", read_fn(2))[0]
+        return _uint16.unpack(read_fn(2))[0]
     elif code == b'\xdd':
-        length = struct.unpack(">I", read_fn(4))[0]
-    else:
-        raise Exception("logic error, not array: 0x%02x" % ord(code))
+        return _uint32.unpack(read_fn(4))[0]
+    raise Exception("logic error, not array: 0x%02x" % ord(code))
 
-    return [_unpackb(read_fn) for i in range(length)]
+def _unpack_array(code, read_fn):
+    length = _unpack_array_length(code, read_fn)
+    dispatch = _unpack_dispatch_table
+    a = []
+    # a counter rather than range(), which builds a list of length ints on
+    # Python 2 before the first element is read
+    while length:
+        length -= 1
+        code = read_fn(1)
+        a.append(dispatch[code](code, read_fn))
+    return a
 
 def _unpack_map(code, read_fn):
     if (ord(code) & 0xf0) == 0x80:
         length = (ord(code) & ~0xf0)
     elif code == b'\xde':
-        length = struct.unpack(">H", read_fn(2))[0]
+        length = _uint16.unpack(read_fn(2))[0]
     elif code == b'\xdf':
-        length = struct.unpack(">I", read_fn(4))[0]
+        length = _uint32.unpack(read_fn(4))[0]
     else:
         raise Exception("logic error, not map: 0x%02x" % ord(code))
 
+    dispatch = _unpack_dispatch_table
     d = {}
-    for i in range(length):
-        # Unpack key
-        k = _unpackb(read_fn)
+    while length:
+        length -= 1
+        # Unpack key. Maps of the same shape (like the elements of an array
+        # of records) repeat the same short string keys, so their decoded
+        # strings are cached by their raw bytes, which also shares one string
+        # object between all of the maps.
+        code = read_fn(1)
+        if b'\xa0' <= code <= b'\xbf' and not compatibility:
+            raw = read_fn(ord(code) & ~0xe0)
+            k = _unpacked_keys.get(raw)
+            if k is None:
+                k = _unpack_key(raw)
+        else:
+            k = dispatch[code](code, read_fn)
+            if not isinstance(k, collections.Hashable):
+                raise UnhashableKeyException("encountered unhashable key type: %s" % str(type(k)))
 
-        if not isinstance(k, collections.Hashable):
-            raise UnhashableKeyException("encountered unhashable key type: %s" % str(type(k)))
-        elif k in d:
+        if k in d:
             raise DuplicateKeyException("encountered duplicate key: %s, %s" % (str(k), str(type(k))))
 
         # Unpack value
-        v = _unpackb(read_fn)
-
-        d[k] = v
+        code = read_fn(1)
+        d[k] = dispatch[code](code, read_fn)
     return d
 
+def _unpack_key(raw):
+    try:
+        k = bytes.decode(raw, 'utf-8')
+    except UnicodeDecodeError:
+        raise InvalidStringException("unpacked string is not utf-8")
+    if len(_unpacked_keys) < _KEY_CACHE_SIZE:
+        _unpacked_keys[raw] = k
+    return k
+
 ########################################
 
-def _byte_reader(s):
-    i = [0]
+def _unpackb(read_fn):
+    code = read_fn(1)
+    return _unpack_dispatch_table[code](code, read_fn)
+
+def _stream_reader(fp):
     def read_fn(n):
-        if (i[0]+n > len(s)):
+        data = fp.read(n)
+        if len(data) < n:
             raise InsufficientDataException()
-        substring = s[i[0]:i[0]+n]
-        i[0] += n
-        return substring
+        return data
     return read_fn
 
-def _unpackb(read_fn):
+def _unpack(fp):
+    """
+    Deserialize MessagePack bytes read from a file object into a Python
+    object. Only the bytes of the object are consumed, so consecutive objects
+    can be read from the same file object.
+
+    Args:
+        fp: a .read()-supporting file object
+
+    Returns:
+        A deserialized Python object.
+
+    Raises:
+        InsufficientDataException(UnpackException):
+            Insufficient data to unpack the encoded object.
+        InvalidStringException(UnpackException):
+            Invalid UTF-8 string encountered during unpacking.
+        ReservedCodeException(UnpackException):
+            Reserved code encountered during unpacking.
+        UnhashableKeyException(UnpackException):
+            Unhashable key encountered during map unpacking.
+            The serialized map cannot be deserialized into a Python dictionary.
+        DuplicateKeyException(UnpackException):
+            Duplicate key encountered during map unpacking.
+
+    Example:
+    >>> f = open('test.bin', 'rb')
+    >>> umsgpack.unpack(f)
+    {u'compact': True, u'schema': 0}
+    >>>
+    """
+    return _unpackb(_stream_reader(fp))
+
+def unpack_array(fp):
+    """
+    Deserialize a MessagePack array read from a file object one element at a
+    time, so that arrays too large to hold in memory can be processed in
+    constant memory. The file object should be buffered, since elements are
+    read a few bytes at a time.
+
+    Args:
+        fp: a .read()-supporting file object
+
+    Returns:
+        A generator of the deserialized array elements.
+
+    Raises:
+        UnpackException:
+            The next object in the file is not an array.
+        The exceptions raised by unpack() for each element.
+
+    Example:
+    >>> f = open('test.bin', 'rb')
+    >>> for x in umsgpack.unpack_array(f):
+    ...     print(x)
+    ...
+    >>>
+    """
+    read_fn = _stream_reader(fp)
     code = read_fn(1)
-    return _unpack_dispatch_table[code](code, read_fn)
+    if _unpack_dispatch_table[code] is not _unpack_array:
+        raise UnpackException("not an array: 0x%02x" % ord(code))
+
+    length = _unpack_array_length(code, read_fn)
+    while length:
+        length -= 1
+        yield _unpackb(read_fn)
 
 # For Python 2, expects a str object
 def _unpackb2(s):
@@ -606,7 +871,7 @@ def _unpackb2(s):
     """
     if not isinstance(s, str):
         raise TypeError("packed data is not type 'str'")
-    read_fn = _byte_reader(s)
+    read_fn = _stream_reader(io.BytesIO(s))
     return _unpackb(read_fn)
 
 # For Python 3, expects a bytes object
@@ -642,19 +907,27 @@ def _unpackb3(s):
     """
     if not isinstance(s, bytes):
         raise TypeError("packed data is not type 'bytes'")
-    read_fn = _byte_reader(s)
+    read_fn = _stream_reader(io.BytesIO(s))
     return _unpackb(read_fn)
 
 ################################################################################
 
 def __init():
+    global pack
     global packb
+    global unpack
     global unpackb
+    global dump
     global dumps
+    global load
     global loads
     global compatibility
     global _float_size
+    global _text_type
+    global _pack_dispatch_table
     global _unpack_dispatch_table
+    global _packed_keys
+    global _unpacked_keys
 
     # Compatibility mode for handling strings/bytes with the old specification
     compatibility = False
@@ -665,33 +938,70 @@ def __init():
     else:
         _float_size = 32
 
-    # Map packb and unpackb to the appropriate version
+    # Map pack, packb, unpack and unpackb to the appropriate version
     if sys.version_info[0] == 3:
+        pack = _pack3
         packb = _packb3
+        dump = _pack3
         dumps = _packb3
         unpackb = _unpackb3
         loads = _unpackb3
     else:
+        pack = _pack2
         packb = _packb2
+        dump = _pack2
         dumps = _packb2
         unpackb = _unpackb2
         loads = _unpackb2
+    unpack = _unpack
+    load = _unpack
+
+    # Build a dispatch table for fast lookup of the packing function of the
+    # exact built-in types (used outside of compatibility mode)
+    if sys.version_info[0] == 3:
+        _text_type = str
+        _pack_dispatch_table = {
+            int: _pack_integer,
+            str: _pack_string,
+            bytes: _pack_binary,
+        }
+    else:
+        _text_type = unicode
+        _pack_dispatch_table = {
+            int: _pack_integer,
+            long: _pack_integer,
+            unicode: _pack_string,
+            str: _pack_binary,
+        }
+    _pack_dispatch_table.update({
+        type(None): _pack_nil,
+        bool: _pack_boolean,
+        float: _pack_float,
+        list: _pack_array,
+        tuple: _pack_array,
+        dict: _pack_map,
+        Ext: _pack_ext,
+    })
+
+    # Caches of the encoding and decoding of short string map keys
+    _packed_keys = {}
+    _unpacked_keys = {}
 
     # Build a dispatch table for fast lookup of unpacking function
 
     _unpack_dispatch_table = {}
     # Fix uint
     for code in range(0, 0x7f+1):
-        _unpack_dispatch_table[struct.pack("B", code)] = _unpack_integer
+        _unpack_dispatch_table[_uint8.pack(code)] = _unpack_positive_fixint
     # Fix map
     for code in range(0x80, 0x8f+1):
-        _unpack_dispatch_table[struct.pack("B", code)] = _unpack_map
+        _unpack_dispatch_table[_uint8.pack(code)] = _unpack_map
     # Fix array
     for code in range(0x90, 0x9f+1):
-        _unpack_dispatch_table[struct.pack("B", code)] = _unpack_array
+        _unpack_dispatch_table[_uint8.pack(code)] = _unpack_array
     # Fix str
     for code in range(0xa0, 0xbf+1):
-        _unpack_dispatch_table[struct.pack("B", code)] = _unpack_string
+        _unpack_dispatch_table[_uint8.pack(code)] = _unpack_string
     # Nil
     _unpack_dispatch_table[b'\xc0'] = _unpack_nil
     # Reserved
@@ -701,25 +1011,25 @@ def __init():
     _unpack_dispatch_table[b'\xc3'] = _unpack_boolean
     # Bin
     for code in range(0xc4, 0xc6+1):
-        _unpack_dispatch_table[struct.pack("B", code)] = _unpack_binary
+        _unpack_dispatch_table[_uint8.pack(code)] = _unpack_binary
     # Ext
     for code in range(0xc7, 0xc9+1):
-        _unpack_dispatch_table[struct.pack("B", code)] = _unpack_ext
+        _unpack_dispatch_table[_uint8.pack(code)] = _unpack_ext
     # Float
-    _unpack_dispatch_table[b'\xca'] = _unpack_float
-    _unpack_dispatch_table[b'\xcb'] = _unpack_float
+    _unpack_dispatch_table[b'\xca'] = _unpack_struct(_float32)
+    _unpack_dispatch_table[b'\xcb'] = _unpack_struct(_float64)
     # Uint
-    for code in range(0xcc, 0xcf+1):
-        _unpack_dispatch_table[struct.pack("B", code)] = _unpack_integer
+    for code, s in zip(range(0xcc, 0xcf+1), (_uint8, _uint16, _uint32, _uint64)):
+        _unpack_dispatch_table[_uint8.pack(code)] = _unpack_struct(s)
     # Int
-    for code in range(0xd0, 0xd3+1):
-        _unpack_dispatch_table[struct.pack("B", code)] = _unpack_integer
+    for code, s in zip(range(0xd0, 0xd3+1), (_int8, _int16, _int32, _int64)):
+        _unpack_dispatch_table[_uint8.pack(code)] = _unpack_struct(s)
     # Fixext
     for code in range(0xd4, 0xd8+1):
-        _unpack_dispatch_table[struct.pack("B", code)] = _unpack_ext
+        _unpack_dispatch_table[_uint8.pack(code)] = _unpack_ext
     # String
     for code in range(0xd9, 0xdb+1):
-        _unpack_dispatch_table[struct.pack("B", code)] = _unpack_string
+        _unpack_dispatch_table[_uint8.pack(code)] = _unpack_string
     # Array
     _unpack_dispatch_table[b'\xdc'] = _unpack_array
     _unpack_dispatch_table[b'\xdd'] = _unpack_array
@@ -728,6 +1038,6 @@ def __init():
     _unpack_dispatch_table[b'\xdf'] = _unpack_map
     # Negative fixint
     for code in range(0xe0, 0xff+1):
-        _unpack_dispatch_table[struct.pack("B", code)] = _unpack_integer
+        _unpack_dispatch_table[_uint8.pack(code)] = _unpack_negative_fixint
 
 __init()
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+"""
+This script computes the live-heap bytes over time from a filtered mtrace json
+file (the output of filter.py): the total number of live bytes after every
+entry, each label's live bytes after each of its entries, and the peak working
+set (the most bytes live at once), globally and per label, along with the
+timestamps at which the peaks first occur.
+
+The filtered trace is sorted by time, so the total is a single cumulative sum
+of +bytes (alloc) / -bytes (free). The per-label series take one stable sort
+by label and a cumulative sum restarted at each label, and the per-label peaks
+one more sort, for O(n log n) overall. All results are flat NumPy arrays.
+analyze.py's live_bytes and peak_working_set metrics are computed with
+working_set as well:
+
+  ./working_set.py filtered.json
+  ./working_set.py filtered.json -o working_set.npz --csv timeline.csv
+"""
+
+from __future__ import print_function
+import sys, argparse, array
+import numpy as np
+import tracefile
+
+# global constants
+BAD_FREE_TYPE = -1
+ALLOC_TYPE = 1
+
+def printerr(*args):
+  print(*args, file=sys.stderr)
+
+def read_deltas(data, strings):
+  """ Returns the times, label ids and signed byte deltas of the trace `data`. """
+  times, labels, deltas = array.array('d'), array.array('i'), array.array('l')
+  for item in data:
+    if item['type'] == BAD_FREE_TYPE: continue
+    times.append(item['timestamp'])
+    labels.append(strings.intern(item['name']))
+    deltas.append(item['bytes'] if item['type'] == ALLOC_TYPE else
+        -item['bytes'])
+  return (np.frombuffer(times, dtype=np.float64),
+      np.frombuffer(labels, dtype=np.intc), np.frombuffer(deltas, dtype=np.int_))
+
+def group_by_label(labels, *columns):
+  """
+  Stable-sorts `columns` by label, so each label's entries keep their trace
+  order. Returns (label ids, starts, counts, sorted columns...).
+  """
+  order = np.argsort(labels, kind='mergesort')
+  label_ids, starts, counts = np.unique(labels[order], return_index=True,
+      return_counts=True)
+  return (label_ids, starts, counts) + tuple(c[order] for c in columns)
+
+def running_totals(starts, counts, deltas):
+  """
+  Returns the running sum of `deltas` restarted at each group, where the
+  groups are given by `starts` and `counts`.
+  """
+  totals = np.cumsum(deltas)
+  return totals - np.repeat(totals[starts] - deltas[starts], counts)
+
+def working_set(times, labels, deltas):
+  """
+  Given the time-sorted `times`, label ids and signed byte `deltas` of the
+  trace's entries, returns a dict of arrays:
+    total_times, total: the total live bytes after each entry.
+    peak, peak_time: the global peak working set and when it's first reached.
+    labels, starts, counts, times, values: each label's live bytes after
+      each of its entries; the series of labels[i] is
+      values[starts[i]:starts[i] + counts[i]].
+    peaks, peak_times: each label's peak working set and when it's first
+      reached.
+  """
+  total = np.cumsum(deltas)
+  if len(total):
+    peak_index = np.argmax(total)
+    peak, peak_time = total[peak_index], times[peak_index]
+  else:
+    peak, peak_time = 0, np.nan
+
+  label_ids, starts, counts, label_times, label_deltas = group_by_label(labels,
+      times, deltas)
+  values = running_totals(starts, counts, label_deltas)
+
+  # sort each label's entries by decreasing value, then by time, so that the
+  # first entry of each label is its earliest peak
+  groups = np.repeat(np.arange(len(starts)), counts)
+  order = np.lexsort((np.arange(len(values)), -values, groups))
+  peak_indices = order[starts]
+
+  return {"total_times": times, "total": total, "peak": np.array(peak),
+      "peak_time": np.array(peak_time), "labels": label_ids, "starts": starts,
+      "counts": counts, "times": label_times, "values": values,
+      "peaks": values[peak_indices], "peak_times": label_times[peak_indices]}
+
+def report(names, result):
+  print("Peak working set: %d bytes at %f" %
+      (result["peak"], result["peak_time"]))
+  print("%-32s %14s %20s" % ("label", "peak bytes", "at"))
+  order = np.argsort(-result["peaks"], kind='mergesort')
+  for i in order:
+    name = names[result["labels"][i]] or "<unlabeled>"
+    print("%-32s %14d %20f" % (name, result["peaks"][i],
+        result["peak_times"][i]))
+
+def main(args):
+  strings = tracefile.StringTable()
+  data = tracefile.iter_trace(args.filename)
+  result = working_set(*read_deltas(data, strings))
+
+  if args.output:
+    np.savez_compressed(args.output,
+        names=np.array(strings.strings, dtype=np.unicode_), **result)
+  if args.csv:
+    with open(args.csv, 'w') as f:
+      f.write("timestamp,live_bytes\n")
+      for ts, total in zip(result["total_times"], result["total"]):
+        f.write("%r,%d\n" % (float(ts), total))
+  report(strings.strings, result)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("filename", nargs="?", metavar="filtered.json",
+      type=argparse.FileType('r'), default=sys.stdin,
+      help="filename for filtered json or msgpack. leave empty to use "
+      "standard input")
+  parser.add_argument("-o", "--output", type=str, default=None,
+      help="write all of the arrays to this .npz file")
+  parser.add_argument("--csv", type=str, default=None,
+      help="write the total live bytes timeline to this csv file")
+
+  args = parser.parse_args()
+  sys.exit(main(args))